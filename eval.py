@@ -3,19 +3,16 @@ import os
 from pathlib import Path
 
 import argparse
-import matplotlib.pyplot as plt
 import numpy as np
+import torch
 from tqdm import tqdm
 from stable_baselines3 import PPO
-from stable_baselines3.common.atari_wrappers import WarpFrame
-from stable_baselines3.common.env_util import make_vec_env
-from stable_baselines3.common.vec_env import VecNormalize, DummyVecEnv
-from joblib import load
 from viper_extract import DTClassifierModel
+from utils.tree_kernel import load_compiled_tree
 
 
 import utils.parser.parser
-from scobi import Environment
+from utils.evaluation import make_eval_env, episode_seeds, run_episodes
 
 
 def flist(l):
@@ -45,10 +42,9 @@ def _save_evals(rewards, mean_rewards, mean_steps, csv_filename):
 def _load_viper(exp_name, path_provided):
     if path_provided:
         viper_path = Path(exp_name)
-        model = load(sorted(viper_path.glob("*_best.viper"))[0])
     else:
         viper_path = Path("resources/viper_extracts/extract_output", exp_name + "-extraction")
-        model = load(sorted(viper_path.glob("*_best.viper"))[0])
+    model = load_compiled_tree(sorted(viper_path.glob("*_best.viper"))[0])
 
     wrapped = DTClassifierModel(model)
 
@@ -90,6 +86,9 @@ def main():
     viper = flag_dictionary["viper"]
     progress_bar = flag_dictionary["progress"]
     time = int(flag_dictionary["times"])
+    headless = flag_dictionary["headless"]
+    n_envs = int(flag_dictionary["environments"])
+    n_shards = int(flag_dictionary["shards"])
 
     if version == -1:
         version = utils.parser.parser.get_highest_version(exp_name)
@@ -107,21 +106,8 @@ def main():
         print('Delete the folder ' + str(ff_file_path) + ' or complete the training process')
         return
     EVAL_ENV_SEED = 84
-    if variant == "rgb":
-        env = make_vec_env(env_str, seed=EVAL_ENV_SEED, wrapper_class=WarpFrame)
-    else:
-        env = Environment(env_str,
-                          focus_dir=ff_file_path,
-                          focus_file=pruned_ff_name,
-                          hide_properties=hide_properties,
-                          draw_features=True, # implement feature attribution
-                          reward=0) #env reward only for evaluation
-
-        _, _ = env.reset(seed=EVAL_ENV_SEED)
-        dummy_vecenv = DummyVecEnv([lambda :  env])
-        env = VecNormalize.load(vecnorm_path, dummy_vecenv)
-        env.training = False
-        env.norm_reward = False
+    env = make_eval_env(variant, env_str, ff_file_path, pruned_ff_name, hide_properties, vecnorm_path, EVAL_ENV_SEED,
+                        n_envs=n_envs, n_shards=n_shards, headless=headless)
     if viper:
         print("loading viper tree of " + exp_name)
         if isinstance(viper, str):
@@ -131,63 +117,26 @@ def main():
     else:
         model = PPO.load(model_path)
 
-    current_episode = 0
-    rewards = []
-    steps = []
-    current_rew = 0
-    current_step = 0
-    obs = env.reset()
-    if variant == "rgb":
-        img = plt.imshow(env.get_images()[0])
-    else:
-        scobi_env = env.venv.envs[0]
-        img = plt.imshow(scobi_env.obj_obs)
-
-    if progress_bar:
-        with tqdm(total=time, desc="Episodes completed") as pbar:
-            while True:
-                action, _ = model.predict(obs, deterministic=True)
-                obs, reward, done, info = env.step(action)
-
-                current_rew += reward #scobi_env.original_reward
-                current_step += 1
-                if done:
-                    current_episode += 1
-                    pbar.update(1)
-                    rewards.append(current_rew)
-                    steps.append(current_step)
-                    current_rew = 0
-                    current_step = 0
-                    obs = env.reset()
-                if current_episode == time:
-                    mean_rewards = np.mean(rewards)
-                    print(f"rewards: {flist(rewards)} | mean: {np.mean(rewards):.2f} \n steps: {flist(steps)} | mean: {np.mean(steps):.2f}")
-                    _save_evals(rewards, mean_rewards, np.mean(steps), "resources/checkpoints/" + exp_name + "/" + "evaluation")
-                    _add_eval_modelcard(ff_file_path / "README.md", current_episode, mean_rewards,
-                                        np.sqrt(np.mean((np.array(rewards) - mean_rewards) ** 2)))
-                    pbar.close()
-                    break
-    else:
-        while True:
-                action, _ = model.predict(obs, deterministic=True)
-                obs, reward, done, info = env.step(action)
-
-                current_rew += reward #scobi_env.original_reward
-                current_step += 1
-                if done:
-                    current_episode += 1
-                    rewards.append(current_rew)
-                    steps.append(current_step)
-                    current_rew = 0
-                    current_step = 0
-                    obs = env.reset()
-                if current_episode == time:
-                    mean_rewards = np.mean(rewards)
-                    print(f"rewards: {flist(rewards)} | mean: {np.mean(rewards):.2f} \n steps: {flist(steps)} | mean: {np.mean(steps):.2f}")
-                    _save_evals(rewards, mean_rewards, np.mean(steps), "resources/checkpoints/" + exp_name + "/" + "evaluation")
-                    _add_eval_modelcard(ff_file_path / "README.md", current_episode, mean_rewards,
-                                        np.sqrt(np.mean((np.array(rewards) - mean_rewards) ** 2)))
-                    break
+    if not headless:
+        env.reset()
+        import matplotlib.pyplot as plt # only needed for rendering
+        if variant == "rgb":
+            img = plt.imshow(env.get_images()[0])
+        else:
+            scobi_env = env.venv.envs[0]
+            img = plt.imshow(scobi_env.obj_obs)
+
+    pbar = tqdm(total=time, desc="Episodes completed") if progress_bar else None
+    with torch.inference_mode(): # predictions only, no autograd bookkeeping
+        rewards, steps = run_episodes(model, env, episode_seeds(EVAL_ENV_SEED, time), pbar)
+    env.close()
+    if pbar is not None:
+        pbar.close()
+    mean_rewards = np.mean(rewards)
+    print(f"rewards: {flist(rewards)} | mean: {np.mean(rewards):.2f} \n steps: {flist(steps)} | mean: {np.mean(steps):.2f}")
+    _save_evals(rewards, mean_rewards, np.mean(steps), "resources/checkpoints/" + exp_name + "/" + "evaluation")
+    _add_eval_modelcard(ff_file_path / "README.md", time, mean_rewards,
+                        np.sqrt(np.mean((np.array(rewards) - mean_rewards) ** 2)))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -7,7 +7,7 @@ from scobi import Environment
 from ns_policies.SCoBOts_framework.utils.parser.parser import render_parser, get_highest_version
 from ns_policies.SCoBOts_framework.utils.renderer import Renderer
 from viper_extract import DTClassifierModel
-from joblib import load
+from utils.tree_kernel import load_compiled_tree
 
 
 def flist(l):
@@ -17,10 +17,9 @@ def flist(l):
 def _load_viper(exp_name, path_provided):
     if path_provided:
         viper_path = Path(exp_name)
-        model = load(sorted(viper_path.glob("*_best.viper"))[0])
     else:
         viper_path = Path("resources/viper_extracts/extract_output", exp_name + "-extraction")
-        model = load(sorted(viper_path.glob("*_best.viper"))[0])
+    model = load_compiled_tree(sorted(viper_path.glob("*_best.viper"))[0])
 
     wrapped = DTClassifierModel(model)
 
@@ -44,6 +43,7 @@ def main():
     record = flag_dictionary["record"]
     nb_frames = flag_dictionary["nb_frames"]
     print_reward = flag_dictionary["print_reward"]
+    async_overlays = flag_dictionary["async_overlays"]
     
     if version == -1:
         version = get_highest_version(exp_name)
@@ -69,6 +69,7 @@ def main():
                           focus_file=pruned_ff_name,
                           hide_properties=hide_properties,
                           draw_features=True, # implement feature attribution
+                          async_overlays=async_overlays,
                           reward=0) #env reward only for evaluation
 
         _, _ = env.reset(seed=EVAL_ENV_SEED)
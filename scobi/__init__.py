@@ -1 +1,21 @@
-from scobi.core import Environment
+# the envs pull in gymnasium, OC_Atari and (vec envs) stable_baselines3, only import them on first access
+_LAZY_ATTRS = {
+    "Environment": "scobi.core",
+    "VecEnvironment": "scobi.vecenv",
+    "ShardedVecEnvironment": "scobi.vecenv",
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        import importlib
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -3,9 +3,8 @@ import math
 from typing import Tuple
 import numpy as np
 # from scobi.utils.game_object import get_wrapper_class
-from scobi.utils.colors import get_closest_color
-from scobi.utils.decorators import register
-COLOR_INT_MEMORY = {}
+from scobi.utils.colors import get_closest_color_ints
+from scobi.utils.decorators import register, register_kernel
 EPS = np.finfo(np.float64).eps.item()
 # GameObject = get_wrapper_class()
 
@@ -113,10 +112,55 @@ def get_dir_velocity(pos_history: Tuple[int, int, int, int]) -> Tuple[float, flo
 def get_color_name(rgb: Tuple[int, int, int]) -> Tuple[int]:
     if None in rgb:
         return None,
-    # only calc distances if new unseen rgb value
-    if rgb in COLOR_INT_MEMORY:
-        return COLOR_INT_MEMORY[rgb],
-    else:
-        _, col_int = get_closest_color(rgb)
-        COLOR_INT_MEMORY[rgb] = col_int
-        return col_int,
+    # precomputed per rgb value in the color lookup table
+    return int(get_closest_color_ints(rgb)),
+
+
+
+##########################
+# KERNELS TO REGISTER
+##########################
+# Vectorized counterparts of the functions above, used by the focus compute layer.
+# Every argument is a float64 array of shape (..., arg_len) holding one row per
+# function instance, the result has shape (..., return_len). Operations are kept
+# in the same order as in the scalar versions, so results match them bit for bit.
+# Invisible objects are masked by the caller, kernels never see None.
+@register_kernel(name="LINEAR_TRAJECTORY")
+def calc_lin_traj_kernel(a_position, b_history):
+    m = (b_history[..., 3] - b_history[..., 1]) / (b_history[..., 2] - b_history[..., 0] + 0.1)
+    b = b_history[..., 1] - m * b_history[..., 0]
+    disty = (m * a_position[..., 0] + b) - a_position[..., 1]
+    distx = ((a_position[..., 1] - b) / (m + EPS)) - a_position[..., 0]
+    return np.stack((distx, disty), axis=-1)
+
+
+@register_kernel(name="DISTANCE")
+def calc_distance_kernel(a_position, b_position):
+    return b_position - a_position
+
+
+@register_kernel(name="EUCLIDEAN_DISTANCE")
+def calc_euclidean_distance_kernel(a_position, b_position):
+    delta = b_position - a_position
+    return np.sqrt(delta[..., 1:2]**2 + delta[..., 0:1]**2)
+
+
+@register_kernel(name="CENTER")
+def get_center_kernel(a_position, b_position):
+    return (a_position + b_position) / 2
+
+
+@register_kernel(name="VELOCITY")
+def get_velocity_kernel(pos_history):
+    delta = pos_history[..., 2:4] - pos_history[..., 0:2]
+    return np.sqrt(delta[..., 0:1]**2 + delta[..., 1:2]**2)
+
+
+@register_kernel(name="DIR_VELOCITY")
+def get_dir_velocity_kernel(pos_history):
+    return pos_history[..., 2:4] - pos_history[..., 0:2]
+
+
+@register_kernel(name="COLOR")
+def get_color_name_kernel(rgb):
+    return get_closest_color_ints(rgb)[..., np.newaxis]
@@ -5,16 +5,17 @@ import scobi.environments.env_manager as em
 from scobi.utils.game_object import get_wrapper_class
 from scobi.focus import Focus
 from scobi.utils.logging import Logger
+from scobi.utils.feature_index import format_feature # noqa: F401, used to live here
+from scobi.utils.overlay import OverlayRenderer, OverlayWorker
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
-from copy import deepcopy
 
 
 class Environment(Env):
-    def __init__(self, env_name, seed=None, focus_dir="./ns_policies/SCoBOts_framework/resources/focusfiles", focus_file=None, reward=0, hide_properties=False, silent=False, refresh_yaml=True, draw_features=False, hud=False):
+    def __init__(self, env_name, seed=None, focus_dir="./ns_policies/SCoBOts_framework/resources/focusfiles", focus_file=None, reward=0, hide_properties=False, silent=False, refresh_yaml=True, draw_features=False, hud=False, async_overlays=False):
         self.logger = Logger(silent=silent)
         # set buffer_window=2, s.t. we can build POSITION_HISTORY properties, which are needed by all envs.
-        self.oc_env = em.make(env_name, self.logger, hud=hud, buffer_window_size=2)
+        # rgb frames are only kept for drawing the features
+        self.oc_env = em.make(env_name, self.logger, hud=hud, buffer_window_size=2, create_buffer_stacks=["ori"] if draw_features else [])
         self.seed = seed
         self.randomstate = np.random.RandomState(self.seed)
         # TODO: tie to em.make
@@ -39,13 +40,21 @@ class Environment(Env):
         self.action_space_description = self.focus.PARSED_ACTIONS
         self.observation_space_description = self.focus.PARSED_PROPERTIES + self.focus.PARSED_FUNCTIONS #this and feature_vector_desc is redundant
         self.feature_vector_description = self.focus.get_feature_vector_description()
+        self.feature_index = self.focus.FEATURE_INDEX
         self.num_envs = 1
         self.draw_features = draw_features
         self.feature_attribution = []
-        self.render_font = ImageFont.truetype(str(Path(__file__).parent / 'resources' / 'Gidole-Regular.ttf'), size=38)
-        self.obj_obs = None  # observation augmented with objects
-        self._rel_obs = None  # observation augmented with relations
+        self._render_font = None # loaded on first use, only needed for drawing
+        self._overlay_renderer = OverlayRenderer(scale=4)
+        self._obj_overlay = None # observation augmented with objects, drawn when obj_obs is read
+        self._rel_overlay = None # observation augmented with relations, drawn when _rel_obs is read
+        self._rel_overlay_state = None # (frame, feature vector, freeze mask, action) of the last step
+        self._relation_plan = self._build_relation_plan() # built before the overlay worker can use it
         self._top_features = []
+        self._overlay_worker = None # draws the overlays in a background thread, s.t. step does not wait for them
+        if draw_features and async_overlays:
+            self._worker_renderer = OverlayRenderer(scale=4)
+            self._overlay_worker = OverlayWorker(self._draw_overlays, maxsize=2)
 
         self.original_obs = []
         self.original_reward = []
@@ -63,11 +72,9 @@ class Environment(Env):
         if self.noisy_objects:
             self.logger.GeneralInfo("Using noisy object detection (default: std 3, detection error rate 5%)")
 
-        self.reset()
-        self.step(0) # step once to set the feature vector size
+        # the observation size is known from the focus file, no need to step the emulator
         self.observation_space = spaces.Box(low=-2**63, high=2**63 - 2, shape=(self.focus.OBSERVATION_SIZE,), dtype=np.float32)
         self.ale = self.oc_env._env.unwrapped.ale
-        self.reset()
         self.did_reset = False # still require user to properly call a (likely seeded) reset()
 
     def step(self, action):
@@ -78,10 +85,8 @@ class Environment(Env):
             sco_obs, sco_reward = self.focus.get_feature_vector(obs)
             freeze_mask = self.focus.get_current_freeze_mask()
             if self.draw_features:
-                #for drawing features, we need image here, but obs is ns_repr
-                img_obs = self.oc_env._state_buffer_rgb[-1]
-                self.obj_obs = self._draw_objects_overlay(img_obs)
-                self._rel_obs = self._draw_relation_overlay(img_obs, sco_obs, freeze_mask, action)
+                # overlays are only drawn when obj_obs / _rel_obs are read
+                self._invalidate_overlays(sco_obs, freeze_mask, action)
             self.original_obs = obs
             self.original_reward = reward
             self.ep_env_reward_buffer += self.original_reward
@@ -92,7 +97,7 @@ class Environment(Env):
                 self.ep_env_reward = self.ep_env_reward_buffer
                 self.ep_env_reward_buffer = 0
                 self.reset_ep_reward = True
-                self.focus.reward_subgoals = 0
+                self.focus.reset_reward_subgoals()
             final_reward = self._reward_composition_func(sco_reward, reward)
             # self.sco_obs = sco_obs
             return sco_obs, final_reward, truncated, terminated, info # 5
@@ -102,18 +107,74 @@ class Environment(Env):
     def reset(self, *args, **kwargs):
         self.did_reset = True
         # additional scobi reset steps here
-        self.focus.reward_threshold = -1
-        self.focus.reward_history = [0, 0]
+        self.focus.reset_reward_state()
         obs, info = self.oc_env.reset(*args, **kwargs)
         sco_obs, _ = self.focus.get_feature_vector(obs)
+        if self.draw_features:
+            self._invalidate_overlays(sco_obs, self.focus.get_current_freeze_mask(), None)
         return sco_obs, info
     
     @property
     def unwrapped(self):
         return self.oc_env.unwrapped
 
+    @property
+    def render_font(self):
+        if self._render_font is None:
+            from PIL import ImageFont
+            self._render_font = ImageFont.truetype(str(Path(__file__).parent / 'resources' / 'Gidole-Regular.ttf'), size=38)
+        return self._render_font
+
+    @property
+    def obj_obs(self):
+        # rgb frame of the current state with the bounding boxes of the objects
+        # the array is reused and overwritten by the next drawn overlay
+        # with async_overlays: the newest overlay finished by the worker, which may lag behind by a few steps
+        self._pick_up_overlays()
+        if self._obj_overlay is None and self.draw_features:
+            self._obj_overlay = self._draw_objects_overlay(self.oc_env._state_buffer_rgb[-1])
+        return self._obj_overlay
+
+    @property
+    def _rel_obs(self):
+        # 4x scaled rgb frame of the last step with the relations of the feature vector, weighted by the feature attribution
+        # the array is reused and overwritten by the next drawn overlay
+        self._pick_up_overlays()
+        if self._rel_overlay is None and self._rel_overlay_state is not None:
+            self._rel_overlay = self._draw_relation_overlay(*self._rel_overlay_state)
+        return self._rel_overlay
+
+    def _invalidate_overlays(self, feature_vector, freeze_mask, action):
+        # the feature vector and freeze mask buffers are overwritten by the next step, keep copies
+        img_obs = self.oc_env._state_buffer_rgb[-1]
+        self._rel_overlay_state = (img_obs, np.array(feature_vector), np.array(freeze_mask), action)
+        self._obj_overlay = None
+        self._rel_overlay = None
+        if self._overlay_worker is not None:
+            objects = self.oc_env.objects
+            self._overlay_worker.submit((img_obs, [obj.xywh for obj in objects], [obj.rgb for obj in objects],
+                                         self._rel_overlay_state[1], self._rel_overlay_state[2],
+                                         np.array(self.feature_attribution), action))
+
+    def _pick_up_overlays(self):
+        # until the worker finished its first overlay, they are drawn synchronously
+        if self._overlay_worker is None or self._overlay_worker.latest is None:
+            return
+        self._obj_overlay, self._rel_overlay, top_features_names = self._overlay_worker.latest[1]
+        if top_features_names is not None:
+            self._top_features = top_features_names
+
+    @property
+    def overlay_metrics(self):
+        # queue depth, dropped and drawn frames of the overlay worker, None without async_overlays
+        if self._overlay_worker is None:
+            return None
+        return self._overlay_worker.metrics()
+
     def close(self):
         # additional scobi close steps here
+        if self._overlay_worker is not None:
+            self._overlay_worker.close()
         self.oc_env.close()
 
     def set_feature_attribution(self, att):
@@ -144,6 +205,7 @@ class Environment(Env):
 
 
     def _add_margin(self, pil_img, top, right, bottom, left, color):
+        from PIL import Image
         width, height = pil_img.size
         new_width = width + right + left
         new_height = height + top + bottom
@@ -153,192 +215,116 @@ class Environment(Env):
 
 
     def _draw_objects_overlay(self, obs_image, action=None):
-        obs_mod = deepcopy(obs_image)
-        for obj in self.oc_env.objects:
-            mark_bb(obs_mod, obj.xywh, color=obj.rgb, name=str(obj))
-        return obs_mod
+        objects = self.oc_env.objects
+        boxes = [obj.xywh for obj in objects]
+        colors = [_make_darker(obj.rgb) for obj in objects]
+        return self._overlay_renderer.draw_boxes(obs_image, boxes, colors)
 
 
     def _draw_relation_overlay(self, obs_image, feature_vector, freeze_mask, action=None):
-        scale = 4
-        img = Image.fromarray(obs_image)
-        draw = ImageDraw.Draw(img, "RGBA")
-        if len(self.feature_attribution) == 0:
-            img = img.resize((img.size[0]*scale, img.size[1]*scale), resample=Image.BOX)
-            # img = self._add_margin(img,0,img.size[0],0,0, (255,255,255))
-            return np.array(img)
-        features = self.feature_vector_description[0]
-        fv_backmap = self.feature_vector_description[1]
-        i = 0
+        img, top_features_names = self._draw_relations(self._overlay_renderer, obs_image, feature_vector, freeze_mask, self.feature_attribution)
+        if top_features_names is not None:
+            self._top_features = top_features_names
+        return img
+
+
+    def _draw_overlays(self, snapshot):
+        # overlay worker: draws both overlays of a step snapshot with the worker's own renderer, returns copies
+        obs_image, boxes, colors, feature_vector, freeze_mask, feature_attribution, action = snapshot
+        renderer = self._worker_renderer
+        obj_obs = renderer.draw_boxes(obs_image, boxes, [_make_darker(c) for c in colors]).copy()
+        rel_obs, top_features_names = self._draw_relations(renderer, obs_image, feature_vector, freeze_mask, feature_attribution)
+        return obj_obs, rel_obs.copy(), top_features_names
+
+
+    def _draw_relations(self, renderer, obs_image, feature_vector, freeze_mask, feature_attribution):
+        # relation overlay and the names of the top 5 attributed entries (None without attribution)
+        if len(feature_attribution) == 0:
+            return renderer.upscale(obs_image), None
+        renderer.begin_relations(obs_image)
+        feature_index = self.feature_index
         top_features_k = 5
         top_features_names = ["" for _ in range(top_features_k)]
-        if np.ptp(self.feature_attribution):
-            feature_attribution = (255*(self.feature_attribution - np.min(self.feature_attribution))/np.ptp(self.feature_attribution)).astype(int)
+        if np.ptp(feature_attribution):
+            feature_attribution = (255*(feature_attribution - np.min(feature_attribution))/np.ptp(feature_attribution)).astype(int)
             top_features_idxs = np.argsort(feature_attribution)[-top_features_k:][::-1]
-            for feature in features:
-                i += 1
-                idxs = np.where(fv_backmap == i-1)[0]
-                feature_name = feature[0]
-                feature_signature = feature[1]
-                fv_entries = feature_vector[idxs[0]:idxs[-1]+1]
-                fv_attribution = feature_attribution[idxs[0]:idxs[-1]+1]
-                fv_freeze_mask = freeze_mask[idxs[0]:idxs[-1]+1]
-                alpha = int(np.mean(fv_attribution)**2/255)
-                for ii, idx in enumerate(idxs):
-                    if idx in top_features_idxs:
-                        k_idx = np.where(top_features_idxs == idx)[0][0]
-                        top_features_names[k_idx] = format_feature(feature_name, feature_signature, ii)
-                if 0 in fv_freeze_mask:
+            for k_idx, idx in enumerate(top_features_idxs):
+                top_features_names[k_idx] = feature_index.get_entry_name(idx)
+            # per feature alpha (mean attribution) and freeze state, for all features at once
+            starts = [sl.start for sl in feature_index.slices]
+            lengths = np.diff(starts + [len(feature_attribution)])
+            alphas = ((np.add.reduceat(feature_attribution, starts) / lengths)**2/255).astype(int)
+            frozen = np.minimum.reduceat(np.asarray(freeze_mask), starts) == 0
+            radius = 2
+            for i, feature_name, sl, source_sl, target_sl in self._relation_plan:
+                alpha = int(alphas[i])
+                if frozen[i] or alpha == 0: # nothing to blend
                     continue
+                fv_entries = feature_vector[sl]
                 if feature_name == "POSITION":
-                    radius = 2
                     x = fv_entries[0]
                     y = fv_entries[1]
                     coords = (x - radius, y - radius, x + radius, y + radius)
-                    draw.ellipse(coords, fill=(0,0,0,alpha), outline=(0,0,0,alpha))
+                    renderer.ellipse(coords, fill=(0,0,0,alpha), outline=(0,0,0,alpha))
                 elif feature_name == "POSITION_HISTORY":
-                    radius = 2
                     x_t = fv_entries[2]
                     y_t = fv_entries[3]
                     coords_then = (x_t - radius, y_t - radius, x_t + radius, y_t + radius)
-                    draw.ellipse(coords_then, fill=(0,0,0,alpha), outline=(0,0,0, alpha))
+                    renderer.ellipse(coords_then, fill=(0,0,0,alpha), outline=(0,0,0, alpha))
                 elif feature_name == "CENTER":
                     x = fv_entries[0]
                     y = fv_entries[1]
                     coords = (x- radius, y - radius, x + radius, y + radius)
-                    draw.ellipse(coords, fill=(10,100,10, alpha), outline=(0,0,0, alpha))
+                    renderer.ellipse(coords, fill=(10,100,10, alpha), outline=(0,0,0, alpha))
                 elif feature_name == "DISTANCE":
-                    delta = [fv_entries[0], fv_entries[1]]
-                    source_object_coords = feature_signature[0]
-                    idx = -1
-                    for f in features:
-                        idx += 1
-                        if f == source_object_coords:
-                            break
-                    idxs = np.where(fv_backmap == idx)[0]
-                    source_object_coord_values = feature_vector[idxs[0]:idxs[-1]+1]
-                    vector = np.add(source_object_coord_values, delta).tolist()
-                    draw.line(source_object_coord_values + vector, fill=(0,0,255,alpha), width=1)
+                    source_object_coord_values = feature_vector[source_sl][:2]
+                    vector = source_object_coord_values + fv_entries[:2]
+                    renderer.line((*source_object_coord_values, *vector), (0,0,255,alpha), width=1)
                 elif feature_name == "EUCLIDEAN_DISTANCE":
-                    source_object_coords = feature_signature[0]
-                    target_object_coords = feature_signature[1]
-                    idx = -1
-                    for f in features:
-                        idx += 1
-                        if f == source_object_coords:
-                            break
-                    idxs = np.where(fv_backmap == idx)[0]
-                    source_object_coord_values = feature_vector[idxs[0]:idxs[-1]+1]
-                    idx = -1
-                    for f in features:
-                        idx += 1
-                        if f == target_object_coords:
-                            break
-                    idxs = np.where(fv_backmap == idx)[0]
-                    target_object_coord_values = feature_vector[idxs[0]:idxs[-1]+1]
-                    draw.line(source_object_coord_values + target_object_coord_values , fill=(0,0,255,alpha), width=1)
-                elif feature_name == "TODO": # LINEAR_TRAJECTORY
-                    delta = [fv_entries[0], fv_entries[1]]
-                    source_object_coords = feature_signature[0]
-                    idx = -1
-                    for f in features:
-                        idx += 1
-                        if f == source_object_coords:
-                            break
-                    idxs = np.where(fv_backmap == idx)[0]
-                    source_object_coord_values = feature_vector[idxs[0]:idxs[-1]+1]
-                    vector = np.add(source_object_coord_values, delta)#.tolist()
-                    vector = vector / np.sqrt(np.sum(vector**2))
-                    vector *= 100
-                    draw.line(source_object_coord_values + vector.tolist(), fill=(0,255,255,alpha), width=1)
+                    source_object_coord_values = feature_vector[source_sl][:2]
+                    target_object_coord_values = feature_vector[target_sl][:2]
+                    renderer.line((*source_object_coord_values, *target_object_coord_values), (0,0,255,alpha), width=1)
                 elif feature_name == "DIR_VELOCITY":
                     velocity_scaling = 2
-                    velocity_vector = [fv_entries[0], fv_entries[1]]
-                    velocity_vector = np.multiply(velocity_vector, velocity_scaling)
-                    source_object_phistory = feature_signature[0]
-                    idx = -1
-                    for f in features:
-                        idx += 1
-                        if f == source_object_phistory:
-                            break
-                    idxs = np.where(fv_backmap == idx)[0]
-                    source_object_phistory_values = feature_vector[idxs[0]:idxs[-1]+1]
-                    current_coords = source_object_phistory_values[:2]
-                    vector = np.subtract(current_coords, velocity_vector).tolist()
-                    draw.line(current_coords + vector, fill=(0,255,255,alpha), width=2)
+                    velocity_vector = fv_entries[:2] * velocity_scaling
+                    current_coords = feature_vector[source_sl][:2]
+                    vector = current_coords - velocity_vector
+                    renderer.line((*current_coords, *vector), (0,255,255,alpha), width=2)
                 elif feature_name == "VELOCITY":
                     velocity_scaling = 2
-                    velocity_value = [0, fv_entries[0]] #draw velocity as vertical bar
-                    velocity_vector = np.multiply(velocity_value, velocity_scaling)
-                    source_object_phistory = feature_signature[0]
-                    idx = -1
-                    for f in features:
-                        idx += 1
-                        if f == source_object_phistory:
-                            break
-                    idxs = np.where(fv_backmap == idx)[0]
-                    source_object_phistory_values = feature_vector[idxs[0]:idxs[-1]+1]
-                    current_coords = source_object_phistory_values[:2]
-                    vector = np.subtract(current_coords, velocity_vector).tolist()
-                    draw.line(current_coords + vector, fill=(0,255,255,alpha), width=2)
-        #print(top_features_names)
-        # import ipdb; ipdb.set_trace()
-        img = img.resize((img.size[0]*scale, img.size[1]*scale), resample=Image.BOX)
-        self._top_features = top_features_names
-        # img = self._add_margin(img,0,img.size[0],0,0, (255,255,255))
-        # draw = ImageDraw.Draw(img, "RGBA")
-        # draw.text((img.size[0]/2 +20, 50), to_draw, (5, 5, 5), self.render_font)
-        return np.array(img)
+                    velocity_vector = np.array([0, fv_entries[0]]) * velocity_scaling #draw velocity as vertical bar
+                    current_coords = feature_vector[source_sl][:2]
+                    vector = current_coords - velocity_vector
+                    renderer.line((*current_coords, *vector), (0,255,255,alpha), width=2)
+                elif feature_name == "LINEAR_TRAJECTORY":
+                    # horizontal and vertical distance of the object to the trajectory of the other one,
+                    # clipped to the frame (the distances get huge for flat or steep trajectories)
+                    h, w = renderer.relations_frame.shape[:2]
+                    x, y = feature_vector[source_sl][:2]
+                    x_t = np.clip(x + fv_entries[0], -1, w)
+                    y_t = np.clip(y + fv_entries[1], -1, h)
+                    renderer.line((x, y, x_t, y), (255,0,255,alpha), width=1)
+                    renderer.line((x, y, x, y_t), (255,0,255,alpha), width=1)
+        return renderer.upscale(renderer.relations_frame), top_features_names
+
+    def _build_relation_plan(self):
+        # (feature position, name, slice, source slice, target slice) of every feature the relation overlay draws
+        feature_index = self.feature_index
+        relation_plan = []
+        for i, ((feature_name, feature_signature), sl) in enumerate(zip(feature_index.features, feature_index.slices)):
+            if feature_name in ["POSITION", "POSITION_HISTORY", "CENTER"]:
+                relation_plan.append((i, feature_name, sl, None, None))
+            elif feature_name in ["DISTANCE", "DIR_VELOCITY", "VELOCITY", "LINEAR_TRAJECTORY"]:
+                source_sl = feature_index.get_slice(*feature_signature[0])
+                relation_plan.append((i, feature_name, sl, source_sl, None))
+            elif feature_name == "EUCLIDEAN_DISTANCE":
+                source_sl = feature_index.get_slice(*feature_signature[0])
+                target_sl = feature_index.get_slice(*feature_signature[1])
+                relation_plan.append((i, feature_name, sl, source_sl, target_sl))
+        return relation_plan
 
     def get_vector_entry_descriptions(self):
-        features = self.feature_vector_description[0]
-        fv_backmap = self.feature_vector_description[1]
-        i = 0
-        features_names = []
-        for feature in features:
-            idxs = np.where(fv_backmap == i)[0]
-            feature_name = feature[0]
-            feature_signature = feature[1]
-            for ii, idx in enumerate(idxs):
-                features_names.append(format_feature(feature_name, feature_signature, ii))
-            i += 1
-        return features_names
-
-
-def format_feature(feature_name, feature_signature, ii):
-    if feature_name == 'RGB':
-        axis = ["R", "G", "B"][ii]
-        return f"RGB({feature_signature}.{axis})"
-    if feature_name == "POSITION_HISTORY":
-        if ii < 2:
-            axis = ["x", "y"][ii]
-            return f"{feature_signature}.{axis}"
-        axis = ["x", "y"][ii-2]
-        return f"{feature_signature}.{axis}[t-1]"
-    axis = ["x", "y"][ii]
-    if ii > 3:
-        print("feature render formatting error. exiting...")
-        exit()
-    if feature_name == 'POSITION':
-        return f"{feature_signature}.{axis}"
-    elif feature_name == "EUCLIDEAN_DISTANCE":
-        return f"ED({feature_signature[0][1]}, {feature_signature[1][1]})"
-    elif feature_name == "DISTANCE":
-        return f"D({feature_signature[0][1]}, {feature_signature[1][1]}).{axis}"
-    elif feature_name == "VELOCITY":
-        return f"V({feature_signature[0][1]}).{axis}"
-    elif feature_name == "DIR_VELOCITY":
-        return f"DV({feature_signature[0][1]}).{axis}"
-    elif feature_name == "CENTER":
-        return f"C({feature_signature[0][1]}, {feature_signature[1][1]}).{axis}"
-    elif feature_name == "ORIENTATION":
-        return f"O({feature_signature})"
-    elif feature_name == "LINEAR_TRAJECTORY":
-        return f"LT({feature_signature[0][1]}, {feature_signature[1][1]}).{axis}"
-    elif feature_name == "COLOR":
-        return f"COL({feature_signature[0][1]})"
-    print("feature render formatting error. exiting...")
-    exit()
+        return list(self.feature_index.entry_names)
 
 
 def _make_darker(color, col_precent=0.8):
@@ -1,22 +1,31 @@
 from typing import Tuple
-import yaml
+import hashlib
+import json
+import os
+import tempfile
 import numpy as np
-import math
 from pathlib import Path
-from itertools import permutations
+from itertools import product
 from scobi.concepts import init as concept_init
-from scobi.utils.decorators import FUNCTIONS
+from scobi.utils.decorators import FUNCTIONS, KERNELS, registry_fingerprint
+from scobi.utils.reward_spec import RewardProgram, MissingFeature
+from scobi.rewards import get_reward_spec
+from scobi.utils.feature_index import FeatureIndex
 from termcolor import colored
 
+FOCUS_PLAN_VERSION = 1 # bump when the layout of the compiled focus plan changes
+YAML_FINGERPRINT_PREFIX = "# scobi fingerprint: "
+
 class Focus():
     def __init__(self, env_name, reward, hide_properties, fofiles_dir_name, fofile, raw_features, max_obj_dict, actions, refresh_yaml, logger):
         concept_init()
-        self.FUNCTION_LIST = []
+        self.FUNCTION_LIST = None
         self.MAX_NB_OBJECTS = max_obj_dict
         self.INIT_OBJECTS = raw_features
         self.INIT_OBJECT_NAMES = [x.category for x in self.INIT_OBJECTS]
         self.NS_REPR_LIST = []
         self.NS_REPR_TYPES = []
+        self.NS_REPR_INDEX = {}
         self.OBJECT_NAMES = []
 
         self.ACTIONS = actions
@@ -27,9 +36,16 @@ class Focus():
         self.PARSED_PROPERTIES = []
         self.PARSED_FUNCTIONS = []
         self.FEATURE_VECTOR_BACKMAP = []
+        self.FEATURE_INDEX = None
 
         self.PROPERTY_COMPUTE_LAYER = []
         self.FUNC_COMPUTE_LAYER = [] 
+        self.FUNC_COMPUTE_LAYER_IDXS = []
+        self.FUNC_KERNEL_LAYER = []
+        self.NS_REPR_IDXS = []
+        self.NS_REPR_SLICES = []
+        self.HISTORY_GATHER_IDXS = []
+        self.CURRENT_NS_REPR = []
         self.PROPERTY_COMPUTE_LAYER_SIZE = 0
         self.FUNC_COMPUTE_LAYER_SIZE = 0
         self.CURRENT_PROPERTY_COMPUTE_LAYER = []
@@ -43,13 +59,12 @@ class Focus():
         self.FEATURE_VECTOR_FUNCS_SIZE = 0
         self.CURRENT_FEATURE_VECTOR_FUNCS = []
         self.CURRENT_FREEZE_MASK = []
+        self.CURRENT_VALID_MASK = []
 
         self.REWARD_SHAPING = reward
         self.REWARD_FUNC = None
-        self.reward_history = [0, 0]
-        self.reward_threshold = -1
-        self.reward_subgoals = 0
-        self.reward_helper_var = False
+        self.REWARD_STATE = None
+        self.REWARD_ENV_IDXS = np.zeros(1, dtype=np.intp)
         self.HIDE_PROPERTIES = hide_properties
 
         self.running_stats = []
@@ -57,9 +72,7 @@ class Focus():
         # self.generate_property_set()
         self.generate_ns_repr_set()
         self.generate_history_idxs()
-        self.generate_function_set()
         self.last_obs_vector = []
-        self.first_pass = True
 
         fofiles_dir_path = Path.cwd() / Path(fofiles_dir_name)
         fofiles_dir_path.mkdir(exist_ok=True)
@@ -81,8 +94,11 @@ class Focus():
             else:
                 logger.GeneralInfo("Default Focus file %s found." % colored(fofile_path.name, "light_green"))
                 if refresh_yaml:
-                    logger.GeneralInfo("Rebuilding it to make sure it's up-to-date.")
-                    self.generate_fresh_yaml(fofile_path)
+                    if self.read_yaml_fingerprint(fofile_path) == self.get_yaml_fingerprint():
+                        logger.GeneralInfo("It is up-to-date.")
+                    else:
+                        logger.GeneralInfo("Rebuilding it to make sure it's up-to-date.")
+                        self.generate_fresh_yaml(fofile_path)
             self.load_focus_file(fofile_path)
             logger.GeneralInfo("Default Focus File is valid. Imported.")
             self.FOCUSFILEPATH = fofile_path
@@ -100,6 +116,7 @@ class Focus():
                 if self.REWARD_FUNC == "norew":
                     logger.GeneralError("Reward function for %s not implemented!" % colored(self.ENV_NAME, "light_green"))
                 else:
+                    self.REWARD_STATE = self.REWARD_FUNC.new_state(1)
                     logger.GeneralInfo("Reward function is valid. Bound.")
             else:
                 logger.GeneralError("Reward function for %s is expecting properties/concepts that are missing in the focus file!" % colored(self.ENV_NAME, "light_green"))
@@ -128,6 +145,8 @@ class Focus():
             if ns_repr[0] == "POSITION":
                 self.NS_REPR_LIST.insert(i+1, ["POSITION_HISTORY", ns_repr[1]])
                 self.NS_REPR_TYPES.insert(i+1, Tuple[int, int, int, int])
+        # (meaning, object name) -> ns_repr index
+        self.NS_REPR_INDEX = {tuple(ns_repr): i for i, ns_repr in enumerate(self.NS_REPR_LIST)}
 
 
     # def generate_property_set(self):
@@ -141,20 +160,26 @@ class Focus():
     #     exit()
 
     def generate_function_set(self):
+        # ns_repr entries bucketed by type, s.t. only type compatible argument tuples are enumerated.
+        # The buckets are in ns_repr order, so the functions are listed in the same order
+        # as by filtering all permutations of NS_REPR_LIST.
+        type_buckets = {}
+        for i, ns_type in enumerate(self.NS_REPR_TYPES):
+            type_buckets.setdefault(ns_type, []).append(i)
+        self.FUNCTION_LIST = []
         for k, v in FUNCTIONS.items():
-            para_len = len(v["expects"])
-            # property_combis = permutations(self.PROPERTY_LIST, para_len)
-            ns_repr_combis = permutations(self.NS_REPR_LIST, para_len)
             function_sig = [x[0].annotation for x in v["expects"]]
-            for combi in ns_repr_combis:
-                # combi_sig_orig = [PROPERTIES[x[0]]["returns"][0] for x in combi]
-                combi_sig = []
-                for c in combi:
-                    idx = self.NS_REPR_LIST.index(c)
-                    combi_sig.append(self.NS_REPR_TYPES[idx])
-                function_sig = [x[0].annotation for x in v["expects"]]
-                if combi_sig == function_sig:
-                    self.FUNCTION_LIST.append([k, list(combi)])
+            arg_buckets = [type_buckets.get(t, []) for t in function_sig]
+            for combi in product(*arg_buckets):
+                if len(set(combi)) == len(combi): # no ns_repr passed twice
+                    self.FUNCTION_LIST.append([k, [self.NS_REPR_LIST[i] for i in combi]])
+        return self.FUNCTION_LIST
+
+    def get_function_list(self):
+        # the available function set is only needed to write a fresh focus file, generate it on demand
+        if self.FUNCTION_LIST is None:
+            self.generate_function_set()
+        return self.FUNCTION_LIST
 
     # def get_object_by_name(self, name, objs):
     #     if type(objs) is dict:
@@ -181,7 +206,7 @@ class Focus():
         for p in self.NS_REPR_LIST:
             print(p)
         print("---FUNCTIONS---")
-        for f in self.FUNCTION_LIST:
+        for f in self.get_function_list():
             print(f)
 
 
@@ -213,6 +238,7 @@ class Focus():
 
 
     def generate_fresh_yaml(self, fpath):
+        import yaml # only needed when the focus file is (re)generated
         yaml_dict = {
             "ENVIRONMENT" : "",
             "AVAILABLE_CONCEPTS" : {
@@ -240,10 +266,30 @@ class Focus():
         use["objects"] = self.OBJECT_NAMES#[x.name for x in self.OBJECTS]
         use["actions"] = [x for x in self.ACTIONS]
         # use["properties"] = [self.proplist_to_yaml_dict(x) for x in self.PROPERTY_LIST]
-        use["functions"] = [self.funclist_to_yaml_dict(x) for x in self.FUNCTION_LIST]
-
-        with open(fpath, "w") as f:
-            yaml.dump(yaml_dict, f, sort_keys=False)
+        use["functions"] = [self.funclist_to_yaml_dict(x) for x in self.get_function_list()]
+
+        # write to a temp file and move it in place, concurrent envs never see a partial focus file
+        with tempfile.NamedTemporaryFile("w", dir=fpath.parent, prefix=fpath.name, suffix=".tmp", delete=False) as f:
+            f.write(YAML_FINGERPRINT_PREFIX + self.get_yaml_fingerprint() + "\n")
+            yaml.dump(yaml_dict, f, Dumper=getattr(yaml, "CDumper", yaml.Dumper), sort_keys=False) # LibYAML if available
+        os.chmod(f.name, 0o644) # temp files are private by default
+        os.replace(f.name, fpath)
+
+    def get_yaml_fingerprint(self):
+        # fingerprint of everything a fresh focus file is generated from
+        inputs = [self.ENV_NAME, self.OBJECT_NAMES, self.NS_REPR_LIST, [str(t) for t in self.NS_REPR_TYPES], list(self.ACTIONS),
+                  [self.avail_to_yaml_dict(k, v) for k, v in FUNCTIONS.items()]]
+        h = hashlib.sha256(json.dumps(inputs).encode())
+        h.update(registry_fingerprint().encode())
+        return h.hexdigest()
+
+    def read_yaml_fingerprint(self, fpath):
+        # fingerprint stored in the first line of generated focus files, None if there is none
+        with open(fpath, "r") as f:
+            first_line = f.readline()
+        if first_line.startswith(YAML_FINGERPRINT_PREFIX):
+            return first_line[len(YAML_FINGERPRINT_PREFIX):].strip()
+        return None
 
 
     def validate_objects(self, objs):
@@ -277,11 +323,11 @@ class Focus():
             if f[0] not in FUNCTIONS.keys():
                 self.logger.FocusFileParserError("Unknown function in function selection: %s" % f[0])
             for para in f[1]:
-                if para not in self.NS_REPR_LIST:
+                para_idx = self.NS_REPR_INDEX.get(tuple(para))
+                if para_idx is None:
                     self.logger.FocusFileParserError("Unknown property in functions selection: %s" % para[0])
                 if para[1] not in self.OBJECT_NAMES:
                     self.logger.FocusFileParserError("Unknown object in functions selection: %s" % para[1])
-                para_idx = self.NS_REPR_LIST.index(para)
                 parsed_para_sig.append(self.NS_REPR_TYPES[para_idx])
             func_definition = FUNCTIONS[f[0]]
             function_sig = [x[0].annotation for x in func_definition["expects"]]
@@ -331,59 +377,122 @@ class Focus():
 
 
     def load_focus_file(self, fpath):
-        with open(fpath, "r") as f:
-            in_dict = yaml.safe_load(f)
+        # the compiled focus plan is cached next to the focus file, keyed by the focus file content,
+        # the OC_Atari slot layout and the concept registry. A cache hit skips parsing entirely.
+        fpath = Path(fpath)
+        with open(fpath, "rb") as f:
+            content = f.read()
+        plan_key = self.get_focus_plan_key(content)
+        plan_path = fpath.with_suffix(".plan.npz")
+        plan = self.load_focus_plan(plan_path, plan_key)
+        if plan is None:
+            plan = self.compile_focus_plan(content)
+            self.save_focus_plan(plan_path, plan_key, plan)
+        else:
+            self.logger.GeneralInfo("Compiled focus plan %s found." % colored(plan_path.name, "light_green"))
+        self.bind_focus_plan(plan)
+
+    def get_focus_plan_key(self, content):
+        layout = [FOCUS_PLAN_VERSION, self.ENV_NAME, self.NS_REPR_LIST, [str(t) for t in self.NS_REPR_TYPES]]
+        h = hashlib.sha256(content)
+        h.update(json.dumps(layout).encode())
+        h.update(registry_fingerprint().encode())
+        return h.hexdigest()
+
+    def compile_focus_plan(self, content):
+        import yaml # only needed on a focus plan cache miss
+        in_dict = yaml.load(content, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) # LibYAML if available
         parsed_env_name = in_dict["ENVIRONMENT"]
         if self.ENV_NAME != parsed_env_name:
             self.logger.FocusFileParserError("Env and focus file env do not match: %s, %s" % (self.ENV_NAME, parsed_env_name))
         sdict = in_dict["SELECTION"]
-        self.PARSED_OBJECTS = self.import_objects(sdict["objects"])
-        self.PARSED_ACTIONS = self.import_actions(sdict["actions"])
-        self.PARSED_FUNCTIONS = self.import_functions(sdict["functions"])
+        plan = {
+            "objects": self.import_objects(sdict["objects"]),
+            "actions": self.import_actions(sdict["actions"]),
+            "functions": self.import_functions(sdict["functions"]),
+            "backmap": [],
+            "kernels": [],
+            "scalars": []
+        }
         # based on the focus file selection,
         # construct a single layer computation graph for the feature vector:
         # 1     FUNC_COMPUTE_LAYER
+        backmap = plan["backmap"]
         parsed_fv_index = 0
-
-        for ns_repr_type in self.NS_REPR_TYPES:
-            arg_len = len(str(ns_repr_type).split('[')[1][:-1].split(','))
-            for _ in range(arg_len):
-                self.FEATURE_VECTOR_BACKMAP.append(parsed_fv_index)
+        for ns_repr_idxs in self.NS_REPR_IDXS:
+            for _ in ns_repr_idxs:
+                backmap.append(parsed_fv_index)
             parsed_fv_index += 1
 
-        #TODO: ADD NS_REPR to FEATURE_VECTOR_BACKMAP
-        # for p in self.PARSED_PROPERTIES:
-        #     property_name = p[0]
-        #     object_name = p[1]
-        #     prop_name_obj_name_pairs.append((property_name, object_name))
-        #     prop_func = PROPERTIES[property_name]["object"]
-        #     return_len = len(PROPERTIES[property_name]["returns"][0].__args__)
-        #     for _ in range(return_len):
-        #         self.FEATURE_VECTOR_BACKMAP.append(parsed_fv_index)
-        #     parsed_fv_index += 1for p in self.PARSED_PROPERTIES:
-        #     property_name = p[0]
-        #     object_name = p[1]
-        #     prop_name_obj_name_pairs.append((property_name, object_name))
-        #     prop_func = PROPERTIES[property_name]["object"]
-        #     return_len = len(PROPERTIES[property_name]["returns"][0].__args__)
-        #     for _ in range(return_len):
-        #         self.FEATURE_VECTOR_BACKMAP.append(parsed_fv_index)
-        #     parsed_fv_index += 1
-
-        for f in self.PARSED_FUNCTIONS:
-            func_name = f[0]
-            input_props = f[1]
-            property_result_idxs = []
-            for p in input_props:
-                property_name = p[0]
-                object_name = p[1]
-                # property_result_idxs.append(prop_name_obj_name_pairs.index((property_name, object_name)))
-                property_result_idxs.append(self.NS_REPR_LIST.index([property_name, object_name]))
-            f = FUNCTIONS[func_name]["object"]
+        # functions with a registered kernel are grouped by concept, s.t. every concept
+        # is evaluated for all of its instances at once:
+        # concept -> (per argument: ns_repr index rows, feature vector index rows)
+        kernel_groups = {}
+        func_offset = 0
+        for func_name, input_props in plan["functions"]:
+            property_result_idxs = [self.NS_REPR_INDEX[tuple(p)] for p in input_props]
             return_len = len(FUNCTIONS[func_name]["returns"][0].__args__)
             for _ in range(return_len):
-                self.FEATURE_VECTOR_BACKMAP.append(parsed_fv_index)
+                backmap.append(parsed_fv_index)
             parsed_fv_index += 1
+            out_idxs = list(range(func_offset, func_offset + return_len))
+            func_offset += return_len
+            if func_name in KERNELS:
+                arg_rows, out_rows = kernel_groups.setdefault(func_name, ([[] for _ in property_result_idxs], []))
+                for arg_row, j in zip(arg_rows, property_result_idxs):
+                    arg_row.append(self.NS_REPR_IDXS[j])
+                out_rows.append(out_idxs)
+            else: # no kernel available, fall back to the scalar function
+                plan["scalars"].append([func_name, property_result_idxs, out_idxs])
+        for func_name, (arg_rows, out_rows) in kernel_groups.items():
+            arg_idxs = [np.array(arg_row, dtype=np.intp) for arg_row in arg_rows]
+            plan["kernels"].append([func_name, arg_idxs, np.array(out_rows, dtype=np.intp)])
+        plan["backmap"] = np.array(backmap, dtype=np.intp)
+        plan["funcs_size"] = func_offset
+        return plan
+
+    def load_focus_plan(self, plan_path, plan_key):
+        # returns None if there is no valid plan for this key
+        try:
+            with np.load(plan_path, allow_pickle=False) as data:
+                header = json.loads(data["header"].tobytes().decode())
+                if header["key"] != plan_key:
+                    return None
+                plan = {k: header[k] for k in ["objects", "actions", "functions", "scalars", "funcs_size"]}
+                plan["backmap"] = data["backmap"]
+                plan["kernels"] = [[func_name, [data["kernel%i_arg%i" % (k, a)] for a in range(n_args)], data["kernel%i_out" % k]]
+                                   for k, (func_name, n_args) in enumerate(header["kernels"])]
+                return plan
+        except Exception: # missing, outdated or corrupt plan, recompile
+            return None
+
+    def save_focus_plan(self, plan_path, plan_key, plan):
+        header = {k: plan[k] for k in ["objects", "actions", "functions", "scalars", "funcs_size"]}
+        header["key"] = plan_key
+        header["kernels"] = [[func_name, len(arg_idxs)] for func_name, arg_idxs, _ in plan["kernels"]]
+        arrays = {"header": np.frombuffer(json.dumps(header).encode(), dtype=np.uint8), "backmap": plan["backmap"]}
+        for k, (_, arg_idxs, out_rows) in enumerate(plan["kernels"]):
+            for a, idxs in enumerate(arg_idxs):
+                arrays["kernel%i_arg%i" % (k, a)] = idxs
+            arrays["kernel%i_out" % k] = out_rows
+        # write to a temp file and move it in place, concurrent envs never see a partial plan
+        try:
+            with tempfile.NamedTemporaryFile(dir=plan_path.parent, prefix=plan_path.name, suffix=".tmp", delete=False) as f:
+                np.savez(f, **arrays)
+            os.chmod(f.name, 0o644) # temp files are private by default
+            os.replace(f.name, plan_path)
+        except OSError:
+            self.logger.GeneralWarning("Could not write compiled focus plan %s." % colored(plan_path.name, "light_yellow"))
+
+    def bind_focus_plan(self, plan):
+        self.PARSED_OBJECTS = plan["objects"]
+        self.PARSED_ACTIONS = plan["actions"]
+        self.PARSED_FUNCTIONS = plan["functions"]
+        self.FEATURE_VECTOR_BACKMAP = plan["backmap"].tolist()
+        self.FEATURE_INDEX = FeatureIndex(self.NS_REPR_LIST + self.PARSED_FUNCTIONS, plan["backmap"])
+        self.FEATURE_VECTOR_PROPS_SIZE = len(self.HISTORY_GATHER_IDXS)
+        for func_name, property_result_idxs, out_idxs in plan["scalars"]:
+            f = FUNCTIONS[func_name]["object"]
             ol = [0 for _ in range(len(property_result_idxs))]
             def func(prop_results, f=f, idxs=property_result_idxs, outlist=ol):
                 f_in = outlist
@@ -391,45 +500,61 @@ class Focus():
                     f_in[i] = prop_results[j]
                 return f(*f_in)
             self.FUNC_COMPUTE_LAYER.append(func)
+            self.FUNC_COMPUTE_LAYER_IDXS.append(out_idxs)
+        for func_name, arg_idxs, out_rows in plan["kernels"]:
+            self.FUNC_KERNEL_LAYER.append((KERNELS[func_name], arg_idxs, out_rows))
+        self.FEATURE_VECTOR_FUNCS_SIZE = plan["funcs_size"]
+        self.FEATURE_VECTOR_SIZE = self.FEATURE_VECTOR_PROPS_SIZE + self.FEATURE_VECTOR_FUNCS_SIZE
+        # the observation layout is fully determined by the plan
+        if self.HIDE_PROPERTIES:
+            self.OBSERVATION_SIZE = self.FEATURE_VECTOR_FUNCS_SIZE
+        else:
+            self.OBSERVATION_SIZE = self.FEATURE_VECTOR_SIZE
         # init compute layer lists
-        # self.PROPERTY_COMPUTE_LAYER_SIZE = len(self.PROPERTY_COMPUTE_LAYER)
         self.FUNC_COMPUTE_LAYER_SIZE = len(self.FUNC_COMPUTE_LAYER)
-        # self.CURRENT_PROPERTY_COMPUTE_LAYER = [0 for _ in range(self.PROPERTY_COMPUTE_LAYER_SIZE)]
         self.CURRENT_FUNC_COMPUTE_LAYER = [0 for _ in range(self.FUNC_COMPUTE_LAYER_SIZE)]
-    
+        # feature vector buffers, props and funcs are views into the full vector
+        self.CURRENT_FEATURE_VECTOR = np.zeros(self.FEATURE_VECTOR_SIZE, dtype=np.float64)
+        self.CURRENT_FEATURE_VECTOR_PROPS = self.CURRENT_FEATURE_VECTOR[:self.FEATURE_VECTOR_PROPS_SIZE]
+        self.CURRENT_FEATURE_VECTOR_FUNCS = self.CURRENT_FEATURE_VECTOR[self.FEATURE_VECTOR_PROPS_SIZE:]
+        self.CURRENT_VALID_MASK = np.ones(self.FEATURE_VECTOR_SIZE, dtype=bool)
+        self.CURRENT_FREEZE_MASK = np.ones(self.FEATURE_VECTOR_SIZE, dtype=int)
+
     def ns_repr_list_to_func_input(self, ns_repr_list):
-        # might be slow
-        out_list = []
         # This assumes that all types are tuples
-        idx = 0
-        for t in self.NS_REPR_TYPES:
-            # get argument length from tuple string (Tuple[int, int] -> 2)
-            # TODO: Could move this computation to initialization, s.t. its only done once
-            arg_len = len(str(t).split('[')[1][:-1].split(','))
-            out_list.append(tuple(ns_repr_list[idx:idx+arg_len]))
-            idx += arg_len
-        return out_list
+        return [tuple(ns_repr_list[sl]) for sl in self.NS_REPR_SLICES]
     
     def generate_history_idxs(self):
         # finds the indices of position properties and the indices where the history should be inserted
-        # (in obs)
+        # (in obs), and compiles them into a single gather index over the flattened (2, n_props) obs.
+        # The ns_repr layout of the gathered vector is kept in NS_REPR_IDXS / NS_REPR_SLICES.
 
         pos_idxs = [] # array of tuples (x, y) for each position property
         insertion_idxs = []
+        obs_len = sum(len(t.__args__) for (meaning, _), t in zip(self.NS_REPR_LIST, self.NS_REPR_TYPES) if meaning != "POSITION_HISTORY")
+        gather_idxs = []
         i = 0
         added_hists = 0
         for (meaning, name), type_info in zip(self.NS_REPR_LIST, self.NS_REPR_TYPES):
-            arg_len = len(str(type_info).split('[')[1][:-1].split(','))
+            arg_len = len(type_info.__args__)
+            self.NS_REPR_IDXS.append(list(range(len(gather_idxs), len(gather_idxs) + arg_len)))
+            self.NS_REPR_SLICES.append(slice(len(gather_idxs), len(gather_idxs) + arg_len))
             if meaning == "POSITION":
                 pos_idxs.append(i)
                 insertion_idxs.append(i+arg_len+added_hists*4)
                 added_hists += 1
             if meaning == "POSITION_HISTORY":
                 # not in obs yet, so do not add idx
+                # history: [x, y, prev_x, prev_y] of the preceding position, prev from the older buffer
+                pos = pos_idxs[-1]
+                gather_idxs += [obs_len + pos, obs_len + pos + 1, pos, pos + 1]
                 continue
+            gather_idxs += range(obs_len + i, obs_len + i + arg_len)
             i += arg_len
         self.pos_idxs = pos_idxs
         self.insertion_idxs = insertion_idxs
+        self.HISTORY_GATHER_IDXS = np.array(gather_idxs, dtype=np.intp)
+        self.CURRENT_NS_REPR = np.zeros(len(gather_idxs), dtype=np.int64)
 
 
     def add_history_to_obs(self, obs):
@@ -439,14 +564,14 @@ class Focus():
         # obs shape: 2,n_props (2 buffers, n properties)
         # should be: 1,n_props+(num_position_history*4)
         # history: [*h_coords[0], *h_coords[1]] == [x,y,prev_x,prev_y]
-        new_obs = obs[1].copy()
-        histories = [[obs[1, i], obs[1, i+1], obs[0, i], obs[0, i+1]] for i in self.pos_idxs]
-        for i, hist in enumerate(histories):
-            new_obs = np.insert(new_obs, self.insertion_idxs[i], hist)
-        return new_obs
+        # the returned array is reused between calls
+        flat_obs = obs.reshape(-1)
+        if self.CURRENT_NS_REPR.dtype != flat_obs.dtype:
+            self.CURRENT_NS_REPR = np.empty(len(self.HISTORY_GATHER_IDXS), dtype=flat_obs.dtype)
+        return np.take(flat_obs, self.HISTORY_GATHER_IDXS, out=self.CURRENT_NS_REPR)
 
 
-    def get_feature_vector(self, obs):
+    def compute_feature_vector(self, inc_ns_repr_list, out, valid):
         # evaluate a 2 layer computation graph for the feature vector:
         # compute the functions given the properties from the neurosymbolic repres. of OCAtari
         # IN   ns_repres (==property_values)
@@ -454,91 +579,55 @@ class Focus():
         #       function_values
         # OUT   HSTACK(CONCAT(property_values, function_values))
         # Instead of having to compute the properties, we get them from OC_Atari directly
+        # Functions with a kernel are evaluated for all instances of their concept at once,
+        # the remaining ones fall back to their scalar version.
+        # Works on a single history-augmented ns_repr (n_props,) as well as on a batch (n_envs, n_props),
+        # out and valid are filled in place and have the matching (..., FEATURE_VECTOR_SIZE) shape.
+        props = out[..., :self.FEATURE_VECTOR_PROPS_SIZE]
+        funcs = out[..., self.FEATURE_VECTOR_PROPS_SIZE:]
+        props_valid = valid[..., :self.FEATURE_VECTOR_PROPS_SIZE]
+        funcs_valid = valid[..., self.FEATURE_VECTOR_PROPS_SIZE:]
 
-        assert obs.shape[0] == 2, "OC_Atari window-buffer size should be 2"
-        inc_ns_repr_list = self.add_history_to_obs(obs)
-
-        self.CURRENT_PROPERTY_COMPUTE_LAYER = self.ns_repr_list_to_func_input(inc_ns_repr_list)
+        # unpack property layer
+        if inc_ns_repr_list.dtype == object: # None marks entries of invisible objects
+            props_valid[:] = np.not_equal(inc_ns_repr_list, None)
+            props[:] = np.where(props_valid, inc_ns_repr_list, 0)
+        else:
+            props_valid[:] = True
+            props[:] = inc_ns_repr_list
 
         # calc function layer
-        for i in range(self.FUNC_COMPUTE_LAYER_SIZE):
-            f = self.FUNC_COMPUTE_LAYER[i]
-            self.CURRENT_FUNC_COMPUTE_LAYER[i] = f(self.CURRENT_PROPERTY_COMPUTE_LAYER)
-        if self.first_pass:
-            self.first_pass = False
-            props = [i for e in self.CURRENT_PROPERTY_COMPUTE_LAYER for i in e]
-            funcs = [i for e in self.CURRENT_FUNC_COMPUTE_LAYER for i in e]
-            out = props + funcs
-            self.FEATURE_VECTOR_SIZE = len(out)
-            if self.HIDE_PROPERTIES:
-                self.OBSERVATION_SIZE = len(funcs)
-            else:
-                self.OBSERVATION_SIZE = len(out)
-            self.FEATURE_VECTOR_PROPS_SIZE = len(props)
-            self.FEATURE_VECTOR_FUNCS_SIZE = len(funcs)
-            self.CURRENT_FEATURE_VECTOR_PROPS = [0 for _ in range(self.FEATURE_VECTOR_PROPS_SIZE)]
-            self.CURRENT_FEATURE_VECTOR_FUNCS = [0 for _ in range(self.FEATURE_VECTOR_FUNCS_SIZE)]
-            self.CURRENT_FREEZE_MASK = [1 for _ in range(self.FEATURE_VECTOR_SIZE)]
-
-            # unpack property layer
-            idx = 0
-            for f in self.CURRENT_PROPERTY_COMPUTE_LAYER:
-                for ff in f:
-                    self.CURRENT_FEATURE_VECTOR_PROPS[idx] = ff
-                    idx += 1
-            
-            # unpack function layer
-            idx = 0
-            for f in self.CURRENT_FUNC_COMPUTE_LAYER:
-                for ff in f:
-                    self.CURRENT_FEATURE_VECTOR_FUNCS[idx] = ff
-                    idx += 1
-
-            out = self.CURRENT_FEATURE_VECTOR_PROPS + self.CURRENT_FEATURE_VECTOR_FUNCS
-            for e in out:
-                item = 0.0 if e is None else e
-                self.last_obs_vector.append(item)
-
-            if self.REWARD_SHAPING != 0:
-                reward = self.REWARD_FUNC(self.last_obs_vector)
-            else:
-                reward = 0
-            
-            out = self.last_obs_vector
-            if self.HIDE_PROPERTIES:
-                out = out[self.FEATURE_VECTOR_PROPS_SIZE:]
-            return np.asarray(out, dtype=np.float32), reward
+        for kernel, arg_idxs, out_idxs in self.FUNC_KERNEL_LAYER:
+            funcs[..., out_idxs] = kernel(*[props[..., idxs] for idxs in arg_idxs])
+            instance_valid = np.logical_and.reduce([props_valid[..., idxs].all(axis=-1) for idxs in arg_idxs])
+            funcs_valid[..., out_idxs] = instance_valid[..., np.newaxis]
+        if self.FUNC_COMPUTE_LAYER_SIZE:
+            for row in np.ndindex(out.shape[:-1]):
+                self.CURRENT_PROPERTY_COMPUTE_LAYER = self.ns_repr_list_to_func_input(inc_ns_repr_list[row])
+                for i in range(self.FUNC_COMPUTE_LAYER_SIZE):
+                    f = self.FUNC_COMPUTE_LAYER[i]
+                    self.CURRENT_FUNC_COMPUTE_LAYER[i] = f(self.CURRENT_PROPERTY_COMPUTE_LAYER)
+                    for idx, ff in zip(self.FUNC_COMPUTE_LAYER_IDXS[i], self.CURRENT_FUNC_COMPUTE_LAYER[i]):
+                        funcs_valid[row][idx] = ff is not None
+                        funcs[row][idx] = 0 if ff is None else ff
 
-        # unpack property layer
-        idx = 0
-        for f in self.CURRENT_PROPERTY_COMPUTE_LAYER:
-            for ff in f:
-                self.CURRENT_FEATURE_VECTOR_PROPS[idx] = ff
-                idx += 1
-        
-        # unpack function layer
-        idx = 0
-        for f in self.CURRENT_FUNC_COMPUTE_LAYER:
-            for ff in f:
-                self.CURRENT_FEATURE_VECTOR_FUNCS[idx] = ff
-                idx += 1
-
-        out = self.CURRENT_FEATURE_VECTOR_PROPS + self.CURRENT_FEATURE_VECTOR_FUNCS
         # freeze feature entries that are derived from invisible objects
         # objects are distinguished by order, not id
         # if object id=1 on position 1 becomes invisible, and obj id=2, pos=2 remains visible
         # obj with id=2 will be pos=1 and objc id=1 will be first position of hidden objects
-        for i in range(self.FEATURE_VECTOR_SIZE): 
-            if out[i] is None:
-                out[i] = 0 #dont freeze. turns out feezing was very bad
-                #out[i] = self.last_obs_vector[i]
-                self.CURRENT_FREEZE_MASK[i] = 0
-            else:
-                self.CURRENT_FREEZE_MASK[i] = 1
+        out[~valid] = 0 #dont freeze. turns out feezing was very bad
+        return out, valid
+
+
+    def get_feature_vector(self, obs):
+        assert obs.shape[0] == 2, "OC_Atari window-buffer size should be 2"
+        inc_ns_repr_list = self.add_history_to_obs(obs)
+        out, valid = self.compute_feature_vector(inc_ns_repr_list, self.CURRENT_FEATURE_VECTOR, self.CURRENT_VALID_MASK)
+        self.CURRENT_FREEZE_MASK[:] = valid
         self.last_obs_vector = out
-        
+
         if self.REWARD_SHAPING != 0:
-            reward = self.REWARD_FUNC(out)
+            reward = self.REWARD_FUNC.evaluate(out[np.newaxis], self.REWARD_STATE, self.REWARD_ENV_IDXS)[0]
         else:
             reward = 0
         if self.HIDE_PROPERTIES:
@@ -554,115 +643,79 @@ class Focus():
         return self.CURRENT_FREEZE_MASK
     
     def get_reward_func(self, env):
-        fv_description, fv_backmap = self.get_feature_vector_description()
-        i = 0
-        if "Pong" in env:
-            # pong reward function
-            idxs = np.empty(0)
-            for feature in fv_description:
-                i += 1
-                feature_name = feature[0]
-                feature_signature = feature[1]
-                if feature_name == "DISTANCE":
-                    input1 = feature_signature[0]
-                    input2 = feature_signature[1]
-                    if input1[0] == "POSITION" and input1[1] == "Player1" and input2[0] == "POSITION" and input2[1] == "Ball1":
-                        idxs = np.where(fv_backmap == i-1)[0]
-            if not idxs.any():
-                return None
-            # reward when player decreases y-distance to ball
-            def reward(fv, idxs=idxs):
-                v_entries = fv[idxs[0]:idxs[-1]+1]
-                self.reward_history[0] = self.reward_history[1]
-                self.reward_history[1] = abs(v_entries[1]) # absolute distance on y-axis
-                delta = self.reward_history[0] - self.reward_history[1] #decrease in distance: positive sign
-                return delta * 0.1
-            return reward
-        elif "Kangaroo" in env:
-            # kangaroo reward function
-            player_idxs = np.empty(0)
-            distance_idxs = np.empty(0)
-            for feature in fv_description:
-                i += 1
-                feature_name = feature[0]
-                feature_signature = feature[1]
-                if feature_name == "POSITION":
-                    if feature_signature == "Player1":
-                        player_idxs = np.where(fv_backmap == i-1)[0]
-                if feature_name == "DISTANCE":
-                    input1 = feature_signature[0]
-                    input2 = feature_signature[1]
-                    if input1[0] == "POSITION" and input1[1] == "Player1" and input2[0] == "POSITION" and input2[1] == "Ladder1":
-                        distance_idxs = np.where(fv_backmap == i-1)[0]
-            
-            if not (player_idxs.any() and distance_idxs.any()):
-                return None
-            # reward when player achieves new y-coord low and goes to ladder
-            def reward(fv, p_idxs=player_idxs, d_idxs=distance_idxs):
-                p_entries = fv[p_idxs[0]:p_idxs[-1]+1]
-                y_coord_reward = 0
-                if self.reward_threshold == -1: #set starting y
-                    self.reward_threshold = p_entries[1]
-                    y_coord_reward = 0
-                else:
-                    delta = self.reward_threshold - abs(p_entries[1])
-                    if delta > 0:
-                        self.reward_threshold = abs(p_entries[1])
-                        y_coord_reward = delta # reward when player achieves new y-coord low an
-                
-                d_entries = fv[d_idxs[0]:d_idxs[-1]+1]
-                self.reward_history[0] = self.reward_history[1]
-                self.reward_history[1] = abs(d_entries[0]) # x-dist
-                delta = self.reward_history[0] - self.reward_history[1] # decreasing x-distance to Scale1
-                distance_reward = delta if 100 > delta else 0 # ignore 100+ spikes
-                return y_coord_reward + 5 * distance_reward
-            return reward
-        elif "Skiing" in env:
-            # skiing reward function
-            dscale = 1
-            player_position_idxs = np.empty(0)
-            flag_center_idxs = np.empty(0)
-            flag_velocity_idxs = np.empty(0)
-            for feature in fv_description:
-                i += 1
-                feature_name = feature[0]
-                feature_signature = feature[1]
-                if feature_name == "CENTER":
-                    input1 = feature_signature[0]
-                    input2 = feature_signature[1]
-                    if input1[0] == "POSITION" and input1[1] == "Flag1" and input2[0] == "POSITION" and input2[1] == "Flag2":
-                        flag_center_idxs = np.where(fv_backmap == i-1)[0]
-                if feature_name == "POSITION":
-                    if feature_signature == "Player1":
-                        player_position_idxs = np.where(fv_backmap == i-1)[0]
-                if feature_name == "DIR_VELOCITY":
-                    input = feature_signature[0]
-                    if input[0] == "POSITION_HISTORY" and input[1] == "Flag1":
-                        flag_velocity_idxs = np.where(fv_backmap == i-1)[0]
-            if not (player_position_idxs.any() and flag_center_idxs.any() and flag_velocity_idxs.any()):
-                return None
-            # reward for high player velocity and player decreases euc-distance to center of flag1 and flag2
-            def reward(fv, c_idxs=flag_center_idxs, p_idxs=player_position_idxs, v_idxs=flag_velocity_idxs):
-                p_entries = fv[p_idxs[0]:p_idxs[-1]+1]
-                c_entries = fv[c_idxs[0]:c_idxs[-1]+1]
-                v_entries = fv[v_idxs[0]:v_idxs[-1]+1]
-                euc_dist = FUNCTIONS["EUCLIDEAN_DISTANCE"]["object"]
-                player_flag_distance = euc_dist(p_entries, c_entries)[0]
-                self.reward_history[0] = self.reward_history[1]
-                self.reward_history[1] = player_flag_distance
-                delta = self.reward_history[0] - self.reward_history[1] #decrease in distance: positive sign
-                player_flag_distance_delta = delta * dscale if p_entries[1] < c_entries[1] else 0 #only scale and send if next flag is ahead not behind
-                player_flag_distance_delta = player_flag_distance_delta if abs(player_flag_distance_delta) < 20 * dscale else 0 #omit bad delta spikes when new flag in focus
-                euc_velocity_flag = np.clip(math.sqrt((v_entries[0])**2 + (v_entries[1])**2), 0, 10) #clip to 10
-                # emit subgoal reward when player passes through 20x10px area around flag center
-                if p_entries[0] > (c_entries[0] -10) and p_entries[0] < (c_entries[0] + 10)and p_entries[1] > (c_entries[1] -5) and p_entries[1] < (c_entries[1] + 5):
-                    if not self.reward_helper_var:
-                        self.reward_subgoals = 100
-                        self.reward_helper_var = True
-                else:
-                    self.reward_helper_var = False
-                    self.reward_subgoals = 0
-                return self.reward_subgoals + euc_velocity_flag + player_flag_distance_delta
-            return reward
-        else:
+        # compile the reward spec of the game against the feature vector of this focus
+        spec = get_reward_spec(env)
+        if spec is None:
             return "norew"
+        try:
+            return RewardProgram(spec, self.FEATURE_INDEX)
+        except MissingFeature:
+            return None
+
+    def reset_reward_state(self):
+        if self.REWARD_STATE is not None:
+            self.REWARD_FUNC.reset(self.REWARD_STATE, self.REWARD_ENV_IDXS)
+
+    def reset_reward_subgoals(self):
+        if self.REWARD_STATE is not None:
+            self.REWARD_FUNC.end_episode(self.REWARD_STATE, self.REWARD_ENV_IDXS)
+
+
+
+class BatchedFocus():
+    """
+    Computes the feature vectors of n_envs environments sharing one focus in a single pass.
+    Takes the stacked OC_Atari ns_states (n_envs, 2, n_props) and keeps the reward shaping state per env.
+    """
+    def __init__(self, focus, n_envs):
+        self.focus = focus
+        self.n_envs = n_envs
+        self.CURRENT_NS_REPR = np.zeros((n_envs, focus.FEATURE_VECTOR_PROPS_SIZE), dtype=np.int64)
+        self.CURRENT_FEATURE_VECTORS = np.zeros((n_envs, focus.FEATURE_VECTOR_SIZE), dtype=np.float64)
+        self.CURRENT_VALID_MASKS = np.ones((n_envs, focus.FEATURE_VECTOR_SIZE), dtype=bool)
+        self.CURRENT_FREEZE_MASKS = np.ones((n_envs, focus.FEATURE_VECTOR_SIZE), dtype=int)
+        self.CURRENT_REWARDS = np.zeros(n_envs, dtype=np.float64)
+        # reward shaping state of all envs, per env arrays
+        self.reward_state = None
+        if focus.REWARD_SHAPING != 0:
+            self.reward_state = focus.REWARD_FUNC.new_state(n_envs)
+
+    def reset_reward_state(self, env_idx):
+        # mirrors the reward state reset done by Environment.reset
+        if self.reward_state is not None:
+            self.focus.REWARD_FUNC.reset(self.reward_state, [env_idx])
+
+    def reset_reward_subgoals(self, env_idx):
+        # mirrors the subgoal reset done by Environment.step on episode end
+        if self.reward_state is not None:
+            self.focus.REWARD_FUNC.end_episode(self.reward_state, [env_idx])
+
+    def add_history_to_obs(self, obs):
+        # batched counterpart of Focus.add_history_to_obs, the returned array is reused between calls
+        flat_obs = obs.reshape(obs.shape[0], -1)
+        if self.CURRENT_NS_REPR.dtype != flat_obs.dtype:
+            self.CURRENT_NS_REPR = np.empty((self.n_envs, len(self.focus.HISTORY_GATHER_IDXS)), dtype=flat_obs.dtype)
+        return np.take(flat_obs, self.focus.HISTORY_GATHER_IDXS, axis=1, out=self.CURRENT_NS_REPR[:obs.shape[0]])
+
+    def get_feature_vectors(self, obs, env_idxs=None):
+        """
+        Returns the (n_envs, OBSERVATION_SIZE) float32 observations, the shaped rewards (n_envs,)
+        and the freeze masks (n_envs, FEATURE_VECTOR_SIZE) for a stack of OC_Atari ns_states.
+        If env_idxs is given, obs only holds the ns_states of these envs and only their rows are returned.
+        """
+        focus = self.focus
+        if env_idxs is None:
+            env_idxs = range(self.n_envs)
+        n = len(env_idxs)
+        assert obs.shape[:2] == (n, 2), "expecting stacked OC_Atari ns_states of shape (n_envs, 2, n_props)"
+        inc_ns_repr_list = self.add_history_to_obs(obs)
+        out, valid = focus.compute_feature_vector(inc_ns_repr_list, self.CURRENT_FEATURE_VECTORS[:n], self.CURRENT_VALID_MASKS[:n])
+        freeze_masks = self.CURRENT_FREEZE_MASKS[:n]
+        freeze_masks[:] = valid
+
+        rewards = self.CURRENT_REWARDS[:n]
+        if focus.REWARD_SHAPING != 0:
+            rewards[:] = focus.REWARD_FUNC.evaluate(out, self.reward_state, env_idxs)
+        if focus.HIDE_PROPERTIES:
+            out = out[:, focus.FEATURE_VECTOR_PROPS_SIZE:]
+        return np.asarray(out, dtype=np.float32), rewards.copy(), freeze_masks
@@ -0,0 +1,53 @@
+"""Reward shaping specs for scobi reward shaping, one per game"""
+from scobi.utils.reward_spec import Feature, Delta, NewLow, Latch, Abs, Sqrt, Clip, Where
+
+# game -> reward spec, matched against the env name in registration order
+REWARD_SPECS = dict()
+
+
+def register_reward_spec(game, spec):
+    if game in REWARD_SPECS.keys():
+        print("reward spec already registered")
+    else:
+        REWARD_SPECS[game] = spec
+
+
+def get_reward_spec(env_name):
+    for game, spec in REWARD_SPECS.items():
+        if game in env_name:
+            return spec
+    return None
+
+
+##########################
+# REWARD SPECS TO REGISTER
+##########################
+
+# pong: reward when player decreases y-distance to ball
+_pong_ball_distance = Feature("DISTANCE", ("POSITION", "Player1"), ("POSITION", "Ball1"))
+register_reward_spec("Pong", Delta(Abs(_pong_ball_distance[1])) * 0.1)
+
+
+# kangaroo: reward when player achieves new y-coord low and goes to ladder
+_kangaroo_player = Feature("POSITION", "Player1")
+_kangaroo_ladder_distance = Feature("DISTANCE", ("POSITION", "Player1"), ("POSITION", "Ladder1"))
+_kangaroo_x_progress = Delta(Abs(_kangaroo_ladder_distance[0])) # decreasing x-distance to Ladder1
+register_reward_spec("Kangaroo",
+    NewLow(Abs(_kangaroo_player[1]), start=_kangaroo_player[1])
+    + 5 * Where(_kangaroo_x_progress < 100, _kangaroo_x_progress, 0)) # ignore 100+ spikes
+
+
+# skiing: reward for high player velocity and player decreases euc-distance to center of flag1 and flag2
+_skiing_player = Feature("POSITION", "Player1")
+_skiing_flag_center = Feature("CENTER", ("POSITION", "Flag1"), ("POSITION", "Flag2"))
+_skiing_flag_velocity = Feature("DIR_VELOCITY", ("POSITION_HISTORY", "Flag1"))
+_skiing_flag_distance = Sqrt((_skiing_flag_center[1] - _skiing_player[1])**2 + (_skiing_flag_center[0] - _skiing_player[0])**2)
+# only if next flag is ahead not behind
+_skiing_progress = Where(_skiing_player[1] < _skiing_flag_center[1], Delta(_skiing_flag_distance), 0)
+# emit subgoal reward when player passes through 20x10px area around flag center
+_skiing_at_flag = ((_skiing_player[0] > _skiing_flag_center[0] - 10) & (_skiing_player[0] < _skiing_flag_center[0] + 10)
+                   & (_skiing_player[1] > _skiing_flag_center[1] - 5) & (_skiing_player[1] < _skiing_flag_center[1] + 5))
+register_reward_spec("Skiing",
+    Latch(_skiing_at_flag, 100)
+    + Clip(Sqrt(_skiing_flag_velocity[0]**2 + _skiing_flag_velocity[1]**2), 0, 10) # clip to 10
+    + Where(Abs(_skiing_progress) < 20, _skiing_progress, 0)) # omit bad delta spikes when new flag in focus
@@ -1,9 +1,15 @@
-from colormath import color_diff_matrix
-from colormath.color_objects import sRGBColor, LabColor
-from colormath.color_conversions import convert_color
+import hashlib
+import os
+import tempfile
+from pathlib import Path
 import scobi.utils.color_dicts as cdicts
 import numpy as np
 
+# colormath is only needed to fill missing entries of the color lookup table, it is imported on demand
+COLOR_LUT_SIZE = 1 << 24 # all 24-bit rgb values
+_COLOR_LUT = None
+_COLORS_MATRICES = None
+
 # TODO: RF: is this copypaste from colormath?
 def _get_lab_color1_vector(color):
     """
@@ -37,20 +43,29 @@ def delta_e_cmc(color1, color2_matrix, pl=2, pc=1):
       Acceptability: pl=2, pc=1
       Perceptability: pl=1, pc=1
     """
+    from colormath import color_diff_matrix
     color1_vector = _get_lab_color1_vector(color1)
     # color2_matrix = _get_lab_color2_matrix(color2)
     delta_e = color_diff_matrix.delta_e_cmc(
         color1_vector, color2_matrix, pl=pl, pc=pc)[0]
     return delta_e.item()
 
-colors_matrices = {}
-for color_name, rgb in cdicts.CSS3_NAMES_TO_RGB.items():
-    color2_rgb = sRGBColor(*rgb)
-    color2_lab = convert_color(color2_rgb, LabColor)
-    color2_lab_matrix = _get_lab_color2_matrix(color2_lab)
-    colors_matrices[color_name] = color2_lab_matrix
+def _get_colors_matrices():
+    global _COLORS_MATRICES
+    if _COLORS_MATRICES is None:
+        from colormath.color_objects import sRGBColor, LabColor
+        from colormath.color_conversions import convert_color
+        _COLORS_MATRICES = {}
+        for color_name, rgb in cdicts.CSS3_NAMES_TO_RGB.items():
+            color2_rgb = sRGBColor(*rgb)
+            color2_lab = convert_color(color2_rgb, LabColor)
+            color2_lab_matrix = _get_lab_color2_matrix(color2_lab)
+            _COLORS_MATRICES[color_name] = color2_lab_matrix
+    return _COLORS_MATRICES
 
 def _colordist(rgb1, color2_lab_matrix):
+    from colormath.color_objects import sRGBColor, LabColor
+    from colormath.color_conversions import convert_color
     rgb1 = (np.array(rgb1)/255).tolist()
     color1_lab = convert_color(sRGBColor(*rgb1), LabColor)
     delta_e = delta_e_cmc(color1_lab, color2_lab_matrix)
@@ -58,8 +73,55 @@ def _colordist(rgb1, color2_lab_matrix):
 
 # returns str and int of closest color to input rgb
 def get_closest_color(rgb):
-    comp_list = [(c[0], _colordist(rgb, c[1])) for c in colors_matrices.items()] 
+    comp_list = [(c[0], _colordist(rgb, c[1])) for c in _get_colors_matrices().items()]
     comp_list2 = sorted(comp_list, key=lambda el: el[1])
     color_name = comp_list2[0][0]
     color_int = cdicts.COLOR_TO_INT[color_name]
-    return color_name, color_int
\ No newline at end of file
+    return color_name, color_int
+
+
+def _color_lut_path():
+    # the table depends on the color dicts only, key the file by them
+    tables = repr((cdicts.CSS3_NAMES_TO_RGB, cdicts.COLOR_TO_INT)).encode()
+    cache_dir = Path(os.environ.get("SCOBI_CACHE_DIR", Path.home() / ".cache" / "scobi"))
+    return cache_dir / ("color_lut_%s.u8" % hashlib.sha256(tables).hexdigest()[:16])
+
+def get_color_lut():
+    """
+    Lookup table of the closest color int for every 24-bit rgb value, stored as color int + 1 (0: not computed yet).
+    The table is a sparse file in the scobi cache dir (env var 'SCOBI_CACHE_DIR', default ~/.cache/scobi),
+    memory mapped and shared by all processes. Entries are filled on first use of an rgb value.
+    """
+    global _COLOR_LUT
+    if _COLOR_LUT is None:
+        path = _color_lut_path()
+        try:
+            if not path.exists():
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name, suffix=".tmp", delete=False) as f:
+                    f.truncate(COLOR_LUT_SIZE)
+                os.chmod(f.name, 0o644) # temp files are private by default
+                try: # never replace a table another process already filled
+                    os.link(f.name, path)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.unlink(f.name)
+            _COLOR_LUT = np.memmap(path, dtype=np.uint8, mode="r+", shape=(COLOR_LUT_SIZE,))
+        except (OSError, ValueError): # no usable cache dir, keep the table in memory
+            _COLOR_LUT = np.zeros(COLOR_LUT_SIZE, dtype=np.uint8)
+    return _COLOR_LUT
+
+# returns the int of the closest color for an array of rgb values (..., 3), batched counterpart of get_closest_color
+def get_closest_color_ints(rgbs):
+    rgbs = np.asarray(rgbs, dtype=np.int64)
+    keys = (rgbs[..., 0] << 16) | (rgbs[..., 1] << 8) | rgbs[..., 2]
+    lut = get_color_lut()
+    lut_entries = lut[keys]
+    missing = lut_entries == 0
+    if missing.any():
+        for key in np.unique(keys[missing]).tolist():
+            _, color_int = get_closest_color((key >> 16, (key >> 8) & 255, key & 255))
+            lut[key] = color_int + 1
+        lut_entries = lut[keys]
+    return lut_entries.astype(np.int64) - 1
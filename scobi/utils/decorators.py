@@ -1,3 +1,4 @@
+import hashlib
 import inspect
 
 FUNCTIONS = dict()
@@ -31,4 +32,28 @@ def register(*args, **kwargs):
                 PROPERTIES[kwargs["name"]] = sig_dict
             else:
                 print("unknown type")
-    return inner
\ No newline at end of file
+    return inner
+
+KERNELS = dict()
+
+
+# decorator to register a vectorized kernel for an already registered function
+def register_kernel(*args, **kwargs):
+
+    def inner(func):
+        name = kwargs["name"]
+        if name in KERNELS.keys():
+            print("kernel already registered")
+        else:
+            KERNELS[name] = func
+        return func
+    return inner
+
+
+# fingerprint of the registered concepts (names, signatures, kernels), keys compiled focus plans
+def registry_fingerprint():
+    entries = []
+    for name, v in FUNCTIONS.items():
+        expects = [(str(x[0].annotation), x[1]) for x in v["expects"]]
+        entries.append(repr((name, expects, str(v["returns"][0]), name in KERNELS)))
+    return hashlib.sha256("\n".join(entries).encode()).hexdigest()
@@ -0,0 +1,107 @@
+# feature vector index
+# maps features (by position or by name and signature) and the human readable names of their entries
+# to their contiguous slice in the feature vector, built once when the focus file is loaded
+import numpy as np
+
+
+def feature_key(feature_name, feature_signature):
+    # hashable key of a feature description entry
+    # properties: ["POSITION", "Player1"], functions: ["DISTANCE", [["POSITION", "Player1"], ["POSITION", "Ball1"]]]
+    if isinstance(feature_signature, str):
+        return feature_name, feature_signature
+    return feature_name, tuple(tuple(x) for x in feature_signature)
+
+
+class FeatureIndex():
+    def __init__(self, fv_description, fv_backmap):
+        self.features = fv_description
+        self.backmap = np.asarray(fv_backmap, dtype=np.intp)
+        counts = np.bincount(self.backmap, minlength=len(self.features))
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        self.slices = [slice(s, e) for s, e in zip(starts.tolist(), ends.tolist())]
+        self.positions = {}
+        for i, (feature_name, feature_signature) in enumerate(self.features):
+            self.positions.setdefault(feature_key(feature_name, feature_signature), i) # first occurrence
+        self._entry_names = None
+        self._entry_idxs = None
+
+    def __len__(self):
+        return len(self.features)
+
+    def get_position(self, feature_name, feature_signature):
+        # position of the feature in the description, None if not in the feature vector
+        return self.positions.get(feature_key(feature_name, feature_signature))
+
+    def get_slice(self, feature_name, feature_signature):
+        i = self.get_position(feature_name, feature_signature)
+        if i is None:
+            return None
+        return self.slices[i]
+
+    def get_idxs(self, feature_name, feature_signature):
+        # flat feature vector indices of the feature, empty if not in the feature vector
+        sl = self.get_slice(feature_name, feature_signature)
+        if sl is None:
+            return np.empty(0, dtype=np.intp)
+        return np.arange(sl.start, sl.stop)
+
+    def get_entry_name(self, idx):
+        # human readable name of a single feature vector entry
+        i = self.backmap[idx]
+        feature_name, feature_signature = self.features[i]
+        return format_feature(feature_name, feature_signature, idx - self.slices[i].start)
+
+    @property
+    def entry_names(self):
+        # human readable name of every feature vector entry
+        if self._entry_names is None:
+            self._entry_names = []
+            for (feature_name, feature_signature), sl in zip(self.features, self.slices):
+                for ii in range(sl.stop - sl.start):
+                    self._entry_names.append(format_feature(feature_name, feature_signature, ii))
+        return self._entry_names
+
+    def get_entry_idx(self, entry_name):
+        # flat feature vector index of a human readable entry name, None if unknown
+        if self._entry_idxs is None:
+            self._entry_idxs = {}
+            for i, name in enumerate(self.entry_names):
+                self._entry_idxs.setdefault(name, i)
+        return self._entry_idxs.get(entry_name)
+
+
+def format_feature(feature_name, feature_signature, ii):
+    if feature_name == 'RGB':
+        axis = ["R", "G", "B"][ii]
+        return f"RGB({feature_signature}.{axis})"
+    if feature_name == "POSITION_HISTORY":
+        if ii < 2:
+            axis = ["x", "y"][ii]
+            return f"{feature_signature}.{axis}"
+        axis = ["x", "y"][ii-2]
+        return f"{feature_signature}.{axis}[t-1]"
+    axis = ["x", "y"][ii]
+    if ii > 3:
+        print("feature render formatting error. exiting...")
+        exit()
+    if feature_name == 'POSITION':
+        return f"{feature_signature}.{axis}"
+    elif feature_name == "EUCLIDEAN_DISTANCE":
+        return f"ED({feature_signature[0][1]}, {feature_signature[1][1]})"
+    elif feature_name == "DISTANCE":
+        return f"D({feature_signature[0][1]}, {feature_signature[1][1]}).{axis}"
+    elif feature_name == "VELOCITY":
+        return f"V({feature_signature[0][1]}).{axis}"
+    elif feature_name == "DIR_VELOCITY":
+        return f"DV({feature_signature[0][1]}).{axis}"
+    elif feature_name == "CENTER":
+        return f"C({feature_signature[0][1]}, {feature_signature[1][1]}).{axis}"
+    elif feature_name == "ORIENTATION":
+        return f"O({feature_signature})"
+    elif feature_name == "LINEAR_TRAJECTORY":
+        return f"LT({feature_signature[0][1]}, {feature_signature[1][1]}).{axis}"
+    elif feature_name == "COLOR":
+        return f"COL({feature_signature[0][1]})"
+    print("feature render formatting error. exiting...")
+    exit()
@@ -3,10 +3,20 @@
 # only ocatari implemented for now
 from scobi.utils.interfaces import GameObjectInterface
 from typing import Tuple
-from ocatari.ram.game_objects import GameObject as Ocatari_GameObject
 import numpy as np
 import os
 
+# OC_Atari pulls in torch, PIL and matplotlib, its GameObject is only imported once the first object is wrapped
+_Ocatari_GameObject = None
+
+
+def _ocatari_game_object_class():
+    global _Ocatari_GameObject
+    if _Ocatari_GameObject is None:
+        from ocatari.ram.game_objects import GameObject
+        _Ocatari_GameObject = GameObject
+    return _Ocatari_GameObject
+
 
 def get_wrapper_class():
     if not "SCOBI_OBJ_EXTRACTOR" in os.environ:
@@ -25,7 +35,7 @@ def get_wrapper_class():
 class OCAGameObject(GameObjectInterface):
     def __init__(self, ocgo):
         self._number = 1
-        if issubclass(type(ocgo), Ocatari_GameObject):
+        if issubclass(type(ocgo), _ocatari_game_object_class()):
             self.ocgo = ocgo
         else:
             incoming_type = type(ocgo)
@@ -0,0 +1,210 @@
+# numpy rasterizer for the object and relation overlays of scobi environments
+# draws into preallocated uint8 buffers, which are reused (and overwritten) from frame to frame.
+# blending matches PIL's ImageDraw in "RGBA" mode on RGB images.
+import math
+import queue
+import threading
+import numpy as np
+
+
+def _div255(v):
+    # exact round(v / 255) for 0 <= v <= 255*255, as used by PIL
+    v = v + 128
+    return ((v >> 8) + v) >> 8
+
+
+def _slice_bounds(start, stop, n):
+    # start and stop of python slices start:stop over an axis of size n, vectorized
+    start = np.where(start < 0, np.maximum(start + n, 0), np.minimum(start, n))
+    stop = np.where(stop < 0, np.maximum(stop + n, 0), np.minimum(stop, n))
+    return start, np.maximum(stop - start, 0)
+
+
+def _ellipse_masks(w, h):
+    # fill and outline mask of an ellipse with a (w+1, h+1) pixel bounding box
+    yy, xx = np.mgrid[0:h + 1, 0:w + 1]
+    rx, ry = (w + 1) / 2, (h + 1) / 2
+    fill = ((xx + 0.5 - rx) / rx)**2 + ((yy + 0.5 - ry) / ry)**2 <= 1
+    padded = np.pad(fill, 1)
+    interior = fill & padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    return fill, fill & ~interior
+
+
+class OverlayRenderer():
+    def __init__(self, scale=4):
+        self.scale = scale
+        self.shape = None
+        self._ellipse_masks = {}
+
+    def _allocate(self, shape):
+        if self.shape == shape:
+            return
+        h, w, c = shape
+        self.shape = shape
+        self.objects_frame = np.empty(shape, dtype=np.uint8)
+        self.relations_frame = np.empty(shape, dtype=np.uint8)
+        self.canvas = np.empty((h * self.scale, w * self.scale, c), dtype=np.uint8)
+        # upscaling repeats the columns into the row buffer, then the rows into the canvas
+        self._canvas_row = np.empty((h, w * self.scale, c), dtype=np.uint8)
+
+    def draw_boxes(self, frame, boxes, colors):
+        """
+        Copy of frame with the (surrounding) outlines of the boxes (n, 4) as xywh in colors (n, 3).
+        Same pixels as marking the boxes one after the other with core.mark_bb.
+        """
+        self._allocate(frame.shape)
+        out = self.objects_frame
+        np.copyto(out, frame)
+        if len(boxes) == 0:
+            return out
+        h, w = out.shape[:2]
+        x, y, bw, bh = np.asarray(boxes, dtype=np.int64).reshape(-1, 4).T
+        x, bw = np.where(x > 0, x - 1, x), np.where(x > 0, bw + 1, bw)
+        y, bh = np.where(y > 0, y - 1, y), np.where(y > 0, bh + 1, bh)
+        y = np.minimum(h - 1, y)
+        x = np.minimum(w - 1, x)
+        bottom = np.minimum(h - 1, y + bh)
+        right = np.minimum(w - 1, x + bw)
+        # per box: left and right column, top and bottom row
+        rows_start, rows_len = _slice_bounds(y, bottom + 1, h)
+        cols_start, cols_len = _slice_bounds(x, right + 1, w)
+        fixed = np.stack([x, right, y, bottom], axis=1)
+        fixed = np.where(fixed < 0, fixed + np.array([w, w, h, h]), fixed).ravel()
+        start = np.stack([rows_start, rows_start, cols_start, cols_start], axis=1).ravel()
+        length = np.stack([rows_len, rows_len, cols_len, cols_len], axis=1).ravel()
+        is_row = np.tile([False, False, True, True], len(x))
+        segment = np.repeat(np.arange(len(length)), length)
+        var = start[segment] + np.arange(len(segment)) - np.repeat(np.cumsum(length) - length, length)
+        seg_fixed, seg_is_row = fixed[segment], is_row[segment]
+        flat = np.where(seg_is_row, seg_fixed * w + var, var * w + seg_fixed)
+        # later boxes are drawn over earlier ones
+        out.reshape(-1, out.shape[2])[flat] = np.asarray(colors, dtype=np.uint8)[segment // 4]
+        return out
+
+    def begin_relations(self, frame):
+        # start a relation overlay on a copy of frame
+        self._allocate(frame.shape)
+        np.copyto(self.relations_frame, frame)
+        return self.relations_frame
+
+    def _blend(self, pixels, color):
+        # alpha blend the color (r, g, b, a) into the (n, 3) pixels
+        alpha = color[3]
+        blended = pixels.astype(np.int32) * (255 - alpha) + np.asarray(color[:3], dtype=np.int32) * alpha
+        return _div255(blended).astype(np.uint8)
+
+    def ellipse(self, xy, fill, outline):
+        # filled ellipse with outline in the bounding box xy (x0, y0, x1, y1), colors are (r, g, b, a)
+        out = self.relations_frame
+        x0, y0, x1, y1 = [int(v) for v in xy] # truncated like PIL
+        if x1 < x0 or y1 < y0:
+            return
+        key = (x1 - x0, y1 - y0)
+        if key not in self._ellipse_masks:
+            self._ellipse_masks[key] = _ellipse_masks(*key)
+        fill_mask, outline_mask = self._ellipse_masks[key]
+        h, w = out.shape[:2]
+        cx0, cy0, cx1, cy1 = max(x0, 0), max(y0, 0), min(x1 + 1, w), min(y1 + 1, h)
+        if cx1 <= cx0 or cy1 <= cy0:
+            return
+        region = out[cy0:cy1, cx0:cx1]
+        clip = (slice(cy0 - y0, cy1 - y0), slice(cx0 - x0, cx1 - x0))
+        region[fill_mask[clip]] = self._blend(region[fill_mask[clip]], fill)
+        if outline != fill:
+            region[outline_mask[clip]] = self._blend(region[outline_mask[clip]], outline)
+
+    def line(self, xy, color, width=1):
+        # line from (x0, y0) to (x1, y1) in color (r, g, b, a), one pixel per step along the major axis
+        out = self.relations_frame
+        x0, y0, x1, y1 = [float(v) for v in xy]
+        if not all(math.isfinite(v) for v in (x0, y0, x1, y1)):
+            return
+        n = math.ceil(max(abs(x1 - x0), abs(y1 - y0))) + 1
+        t = np.arange(n) / max(n - 1, 1)
+        xs = np.rint(x0 + t * (x1 - x0)).astype(np.int64)
+        ys = np.rint(y0 + t * (y1 - y0)).astype(np.int64)
+        if width > 1: # thicken along the minor axis, pixels stay unique s.t. each is blended once
+            offsets = np.arange(width)[:, np.newaxis] - (width - 1) // 2
+            if abs(x1 - x0) >= abs(y1 - y0):
+                xs, ys = np.tile(xs, width), (ys + offsets).ravel()
+            else:
+                xs, ys = (xs + offsets).ravel(), np.tile(ys, width)
+        h, w = out.shape[:2]
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        flat = ys[inside] * w + xs[inside]
+        pixels = out.reshape(-1, out.shape[2])
+        pixels[flat] = self._blend(pixels[flat], color)
+
+    def upscale(self, frame):
+        # frame scaled by an integer factor into the reused canvas, same pixels as PIL's BOX resize
+        self._allocate(frame.shape)
+        h, w, c = frame.shape
+        self._canvas_row.reshape(h, w, self.scale, c)[:] = frame[:, :, np.newaxis]
+        self.canvas.reshape(h, self.scale, w * self.scale, c)[:] = self._canvas_row[:, np.newaxis]
+        return self.canvas
+
+
+class OverlayWorker():
+    """
+    Draws overlays in a background thread. submit hands a snapshot to the thread through a bounded queue,
+    if the queue is full the oldest (stale) snapshot is dropped. latest holds (frame id, draw(snapshot))
+    of the newest finished overlay, draw has to return arrays that are not reused afterwards.
+    """
+    def __init__(self, draw, maxsize=2):
+        self.draw = draw
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.latest = None
+        self.error = None
+        self.submitted_frames = 0
+        self.dropped_frames = 0
+        self.drawn_frames = 0
+        self.thread = None
+
+    def submit(self, snapshot):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="scobi-overlay", daemon=True)
+            self.thread.start()
+        self.submitted_frames += 1
+        self._put((self.submitted_frames, snapshot))
+
+    def _put(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped_frames += 1
+                except queue.Empty:
+                    pass
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            frame_id, snapshot = item
+            try:
+                result = self.draw(snapshot)
+            except Exception as e: # raised on the next submit
+                self.error = e
+                return
+            self.latest = (frame_id, result)
+            self.drawn_frames += 1
+
+    def metrics(self):
+        latest_id = self.latest[0] if self.latest is not None else 0
+        return {"queue_depth": self.queue.qsize(),
+                "submitted_frames": self.submitted_frames,
+                "dropped_frames": self.dropped_frames,
+                "drawn_frames": self.drawn_frames,
+                "lag_frames": self.submitted_frames - latest_id}
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self._put(None)
+            self.thread.join(timeout=1)
+        self.thread = None
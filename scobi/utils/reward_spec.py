@@ -0,0 +1,262 @@
+"""
+Declarative reward shaping specs.
+A spec is an expression over named features of the feature vector. It is compiled against the
+feature index of a focus into index arrays (RewardProgram) and evaluated on a
+(n_envs, F) batch of feature vectors, the state of stateful terms lives in per env arrays.
+"""
+import numpy as np
+
+
+class MissingFeature(Exception):
+    pass
+
+
+class Expr():
+    # base of all spec expressions, build returns the evaluation function fn(fv, state, env_idxs) -> (n,)
+    def build(self, program):
+        raise NotImplementedError
+
+    def __add__(self, other):
+        return BinOp(np.add, self, other)
+
+    def __radd__(self, other):
+        return BinOp(np.add, other, self)
+
+    def __sub__(self, other):
+        return BinOp(np.subtract, self, other)
+
+    def __rsub__(self, other):
+        return BinOp(np.subtract, other, self)
+
+    def __mul__(self, other):
+        return BinOp(np.multiply, self, other)
+
+    def __rmul__(self, other):
+        return BinOp(np.multiply, other, self)
+
+    def __pow__(self, other):
+        return BinOp(np.power, self, other)
+
+    def __lt__(self, other):
+        return BinOp(np.less, self, other)
+
+    def __gt__(self, other):
+        return BinOp(np.greater, self, other)
+
+    def __and__(self, other):
+        return BinOp(np.logical_and, self, other)
+
+
+def _expr(x):
+    return x if isinstance(x, Expr) else Const(x)
+
+
+class Const(Expr):
+    def __init__(self, value):
+        self.value = value
+
+    def build(self, program):
+        return lambda fv, state, env_idxs, value=self.value: value
+
+
+class BinOp(Expr):
+    def __init__(self, op, a, b):
+        self.op = op
+        self.a = _expr(a)
+        self.b = _expr(b)
+
+    def build(self, program):
+        fa = program.build(self.a)
+        fb = program.build(self.b)
+        return lambda fv, state, env_idxs, op=self.op: op(fa(fv, state, env_idxs), fb(fv, state, env_idxs))
+
+
+class Feature(Expr):
+    """
+    Feature of the feature vector, by name and signature, e.g. Feature("POSITION", "Player1")
+    or Feature("DISTANCE", ("POSITION", "Player1"), ("POSITION", "Ball1")). Index it to get a single entry.
+    """
+    def __init__(self, name, *inputs):
+        self.name = name
+        self.inputs = inputs
+
+    def __getitem__(self, i):
+        return FeatureEntry(self, i)
+
+    def signature(self):
+        if len(self.inputs) == 1 and isinstance(self.inputs[0], str): # property: object name
+            return self.inputs[0]
+        return [list(x) for x in self.inputs] # function: list of [property, object name]
+
+    def build(self, program):
+        idxs = program.get_feature_idxs(self)
+        return lambda fv, state, env_idxs: fv[:, idxs]
+
+
+class FeatureEntry(Expr):
+    def __init__(self, feature, i):
+        self.feature = feature
+        self.i = i
+
+    def build(self, program):
+        idx = program.get_feature_idxs(self.feature)[self.i]
+        return lambda fv, state, env_idxs: fv[:, idx]
+
+
+class Apply(Expr):
+    # elementwise numpy function of expressions
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = [_expr(a) for a in args]
+
+    def build(self, program):
+        fargs = [program.build(a) for a in self.args]
+        return lambda fv, state, env_idxs, func=self.func: func(*[f(fv, state, env_idxs) for f in fargs])
+
+
+def Abs(x):
+    return Apply(np.abs, x)
+
+
+def Sqrt(x):
+    return Apply(np.sqrt, x)
+
+
+def Clip(x, low, high):
+    return Apply(np.clip, x, low, high)
+
+
+def Where(cond, x, y):
+    return Apply(np.where, cond, x, y)
+
+
+class Delta(Expr):
+    """
+    Decrease of x since the previous step: previous x - x. The previous value starts at 0 on env reset.
+    """
+    def __init__(self, x):
+        self.x = _expr(x)
+
+    def build(self, program):
+        fx = program.build(self.x)
+        slot = program.add_state({"previous": 0.0}, on_reset=["previous"])
+        def fn(fv, state, env_idxs):
+            previous = state[slot]["previous"]
+            x = np.broadcast_to(fx(fv, state, env_idxs), env_idxs.shape)
+            delta = previous[env_idxs] - x
+            previous[env_idxs] = x
+            return delta
+        return program.once(fn, slot)
+
+
+class NewLow(Expr):
+    """
+    Amount by which x undercuts its lowest value so far, 0 otherwise.
+    The first step after an env reset only records the start value (default: x).
+    """
+    def __init__(self, x, start=None):
+        self.x = _expr(x)
+        self.start = self.x if start is None else _expr(start)
+
+    def build(self, program):
+        fx = program.build(self.x)
+        fstart = program.build(self.start)
+        slot = program.add_state({"low": -1.0}, on_reset=["low"]) # -1: not set
+        def fn(fv, state, env_idxs):
+            lows = state[slot]["low"]
+            x = np.broadcast_to(fx(fv, state, env_idxs), env_idxs.shape)
+            low = lows[env_idxs]
+            unset = low == -1
+            delta = low - x
+            lower = ~unset & (delta > 0)
+            lows[env_idxs] = np.where(unset, fstart(fv, state, env_idxs), np.where(lower, x, low))
+            return np.where(lower, delta, 0)
+        return program.once(fn, slot)
+
+
+class Latch(Expr):
+    """
+    Subgoal latch: emits value once cond becomes true and keeps emitting it while cond holds.
+    Emits 0 while cond is false. Ending the episode clears the emitted value, but the latch only
+    re-arms once cond became false.
+    """
+    def __init__(self, cond, value):
+        self.cond = _expr(cond)
+        self.value = value
+
+    def build(self, program):
+        fcond = program.build(self.cond)
+        slot = program.add_state({"value": 0.0, "latched": False}, on_episode_end=["value"])
+        def fn(fv, state, env_idxs):
+            values, latched = state[slot]["value"], state[slot]["latched"]
+            cond = np.broadcast_to(fcond(fv, state, env_idxs), env_idxs.shape)
+            value = np.where(cond & ~latched[env_idxs], self.value, np.where(cond, values[env_idxs], 0))
+            values[env_idxs] = value
+            latched[env_idxs] = cond
+            return value
+        return program.once(fn, slot)
+
+
+class RewardProgram():
+    """
+    A reward spec compiled against the FeatureIndex of a focus.
+    The program does not hold any env state, the state of n envs is created with new_state(n)
+    and passed to evaluate, reset and end_episode.
+    """
+    def __init__(self, spec, feature_index):
+        self.feature_index = feature_index
+        self.state_inits = []
+        self.reset_keys = []
+        self.episode_end_keys = []
+        self.built = {}
+        self.values = {}
+        self.spec = _expr(spec)
+        self.func = self.build(self.spec) # raises MissingFeature
+
+    def build(self, expr):
+        # an expression used several times in a spec is built once, s.t. its state is shared
+        if id(expr) not in self.built:
+            self.built[id(expr)] = (expr, expr.build(self))
+        return self.built[id(expr)][1]
+
+    def once(self, fn, slot):
+        # stateful terms are evaluated once per step, no matter how often they are referenced
+        def cached(fv, state, env_idxs):
+            if slot not in self.values:
+                self.values[slot] = fn(fv, state, env_idxs)
+            return self.values[slot]
+        return cached
+
+    def get_feature_idxs(self, feature):
+        idxs = self.feature_index.get_idxs(feature.name, feature.signature())
+        if len(idxs) == 0:
+            raise MissingFeature("%s %s" % (feature.name, feature.signature()))
+        return idxs
+
+    def add_state(self, init, on_reset=(), on_episode_end=()):
+        slot = len(self.state_inits)
+        self.state_inits.append(init)
+        self.reset_keys += [(slot, k) for k in on_reset]
+        self.episode_end_keys += [(slot, k) for k in on_episode_end]
+        return slot
+
+    def new_state(self, n_envs):
+        return [{k: np.full(n_envs, v) for k, v in init.items()} for init in self.state_inits]
+
+    def reset(self, state, env_idxs):
+        # env reset
+        for slot, k in self.reset_keys:
+            state[slot][k][env_idxs] = self.state_inits[slot][k]
+
+    def end_episode(self, state, env_idxs):
+        for slot, k in self.episode_end_keys:
+            state[slot][k][env_idxs] = self.state_inits[slot][k]
+
+    def evaluate(self, fv, state, env_idxs):
+        """
+        Rewards (n,) for the feature vectors fv (n, F) of the envs env_idxs (n,), updates their state.
+        """
+        env_idxs = np.asarray(env_idxs, dtype=np.intp)
+        self.values = {}
+        rewards = self.func(fv, state, env_idxs)
+        return np.broadcast_to(np.asarray(rewards, dtype=np.float64), env_idxs.shape)
@@ -0,0 +1,442 @@
+"""scobi vectorized environments"""
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from gymnasium import spaces
+from stable_baselines3.common.monitor import Monitor
+from stable_baselines3.common.vec_env.base_vec_env import VecEnv, CloudpickleWrapper
+import scobi.environments.env_manager as em
+from scobi.core import Environment
+from scobi.focus import BatchedFocus
+from scobi.utils.logging import Logger
+
+
+class _EnvSlot():
+    # per env state of a VecEnvironment, mirrors the bookkeeping of Environment, EpisodicLifeEnv and Monitor
+    def __init__(self, oc_env, seed):
+        self.oc_env = oc_env
+        self.ale = oc_env._env.unwrapped.ale
+        self.seed = seed
+        self.render_mode = None
+        self.original_obs = []
+        self.original_reward = []
+        self.ep_env_reward = None
+        self.ep_env_reward_buffer = 0
+        self.reset_ep_reward = True
+        self.lives = 0
+        self.episode_return = 0.0
+        self.episode_len = 0
+
+    def step(self, action):
+        # OCAtari returns (obs, reward, truncated, terminated, info), swapped to gymnasium's order here
+        obs, reward, truncated, terminated, info = self.oc_env.step(action)
+        return obs, reward, terminated, truncated, info
+
+    def track_env_reward(self, obs, reward, done):
+        # same as in Environment.step
+        self.original_obs = obs
+        self.original_reward = reward
+        self.ep_env_reward_buffer += reward
+        if self.reset_ep_reward:
+            self.ep_env_reward = None
+            self.reset_ep_reward = False
+        if done:
+            self.ep_env_reward = self.ep_env_reward_buffer
+            self.ep_env_reward_buffer = 0
+            self.reset_ep_reward = True
+
+    def reset_episode(self):
+        self.lives = self.ale.lives()
+        self.episode_return = 0.0
+        self.episode_len = 0
+
+
+class VecEnvironment(VecEnv):
+    """
+    Hosts n_envs OC_Atari environments in a single process and implements the SB3 VecEnv interface.
+    The emulators are stepped from a thread pool (ALE releases the GIL) and all feature vectors are
+    computed in one batched pass over a focus shared by all envs. episodic_life and the 'episode' infos
+    replace the EpisodicLifeEnv and Monitor wrappers of the single env setup.
+    """
+    def __init__(self, env_name, n_envs, seed=None, focus_dir="./ns_policies/SCoBOts_framework/resources/focusfiles", focus_file=None, reward=0, hide_properties=False, silent=False, refresh_yaml=True, hud=False, episodic_life=False, n_threads=None):
+        # the first env is a regular scobi env, it loads the focus shared by all envs
+        template = Environment(env_name, seed=seed, focus_dir=focus_dir, focus_file=focus_file, reward=reward, hide_properties=hide_properties, silent=silent, refresh_yaml=refresh_yaml, hud=hud)
+        self.template_env = template
+        self.focus = template.focus
+        self.focus_file = template.focus_file
+        self.action_space_description = template.action_space_description
+        self.feature_vector_description = template.feature_vector_description
+        self.feature_index = template.feature_index
+        self.episodic_life = episodic_life
+        self.logger = template.logger
+        silent_logger = Logger(silent=True)
+        self.slots = [_EnvSlot(template.oc_env, seed)]
+        for i in range(1, n_envs):
+            env_seed = None if seed is None else seed + i
+            oc_env = em.make(env_name, silent_logger, hud=hud, buffer_window_size=2, create_buffer_stacks=[]) # no rgb frames, like the template
+            oc_env.reset(seed=env_seed)
+            self.slots.append(_EnvSlot(oc_env, env_seed))
+        self.batched_focus = BatchedFocus(self.focus, n_envs)
+        self._reward_composition_func = template._reward_composition_func
+        if n_threads is None:
+            n_threads = min(n_envs, os.cpu_count() or 1)
+        self.pool = ThreadPoolExecutor(max_workers=n_threads) if n_threads > 1 else None
+        self.actions = None
+        self.t_start = time.time()
+        observation_space = spaces.Box(low=-2**63, high=2**63 - 2, shape=(self.focus.OBSERVATION_SIZE,), dtype=np.float32)
+        super().__init__(n_envs, observation_space, template.action_space)
+
+    def _map(self, func, idxs):
+        if self.pool is None:
+            return [func(i) for i in idxs]
+        return list(self.pool.map(func, idxs))
+
+    def _reset_envs(self, idxs, seeds=None):
+        # resets the given envs and returns their feature vectors, like Environment.reset
+        if seeds is None:
+            seeds = [None for _ in idxs]
+        results = self._map(lambda j: self.slots[idxs[j]].oc_env.reset(seed=seeds[j]), range(len(idxs)))
+        for i in idxs:
+            self.batched_focus.reset_reward_state(i)
+            self.slots[i].reset_episode()
+        sco_obs, _, _ = self.batched_focus.get_feature_vectors(np.stack([r[0] for r in results]), idxs)
+        return sco_obs, [r[1] for r in results]
+
+    def _noop_envs(self, idxs):
+        # EpisodicLifeEnv: after a lost life, continue with a no-op step instead of a reset
+        results = self._map(lambda i: self.slots[i].step(0), idxs)
+        sco_obs, _, _ = self.batched_focus.get_feature_vectors(np.stack([r[0] for r in results]), idxs)
+        ended = []
+        for j, i in enumerate(idxs):
+            obs, reward, terminated, truncated, _ = results[j]
+            self.slots[i].track_env_reward(obs, reward, terminated or truncated)
+            if terminated or truncated:
+                self.batched_focus.reset_reward_subgoals(i)
+                ended.append(i)
+            self.slots[i].reset_episode()
+        return sco_obs, ended
+
+    def reset(self):
+        idxs = list(range(self.num_envs))
+        sco_obs, self.reset_infos = self._reset_envs(idxs, self._seeds)
+        self._reset_seeds()
+        return sco_obs
+
+    def reset_envs(self, indices, seeds=None):
+        """
+        Resets only the given envs, e.g. to start an episode with a scheduled seed, and returns their feature vectors.
+        """
+        idxs = list(self._get_indices(indices))
+        sco_obs, reset_infos = self._reset_envs(idxs, seeds)
+        for i, reset_info in zip(idxs, reset_infos):
+            self.reset_infos[i] = reset_info
+        return sco_obs
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        return self._step(range(self.num_envs), self.actions, all_envs=True)
+
+    def step_envs(self, indices, actions):
+        """
+        Steps only the given envs with their actions, e.g. once the other envs have no episodes left to run.
+        Returns their feature vectors, rewards, dones and infos, finished envs are reset as in step.
+        """
+        return self._step(list(self._get_indices(indices)), actions)
+
+    def _step(self, idxs, actions, all_envs=False):
+        # steps the envs idxs with actions[j] for env idxs[j], rows of the results are in the order of idxs
+        results = self._map(lambda j: self.slots[idxs[j]].step(int(actions[j])), range(len(idxs)))
+        sco_obs, sco_rewards, _ = self.batched_focus.get_feature_vectors(np.stack([r[0] for r in results]), None if all_envs else idxs)
+        rewards = np.zeros(len(idxs), dtype=np.float32)
+        dones = np.zeros(len(idxs), dtype=bool)
+        infos = []
+        to_reset, to_noop = [], []
+        for j, (obs, reward, terminated, truncated, info) in enumerate(results):
+            i = idxs[j]
+            slot = self.slots[i]
+            real_done = terminated or truncated
+            slot.track_env_reward(obs, reward, real_done)
+            if real_done:
+                self.batched_focus.reset_reward_subgoals(i)
+            final_reward = self._reward_composition_func(sco_rewards[j], reward)
+            done = real_done
+            if self.episodic_life:
+                lives = slot.ale.lives()
+                if 0 < lives < slot.lives:
+                    done = True
+                slot.lives = lives
+            slot.episode_return += final_reward
+            slot.episode_len += 1
+            info = dict(info)
+            if done:
+                info["episode"] = {"r": round(slot.episode_return, 6), "l": slot.episode_len, "t": round(time.time() - self.t_start, 6)}
+                info["TimeLimit.truncated"] = truncated and not terminated
+                info["terminal_observation"] = sco_obs[j].copy()
+                if real_done or not self.episodic_life:
+                    to_reset.append(i)
+                else:
+                    to_noop.append(i)
+            rewards[j] = final_reward
+            dones[j] = done
+            infos.append(info)
+        row = {i: j for j, i in enumerate(idxs)}
+        if to_noop:
+            noop_obs, ended = self._noop_envs(to_noop)
+            sco_obs[[row[i] for i in to_noop]] = noop_obs
+            to_reset += ended
+        if to_reset:
+            reset_obs, reset_infos = self._reset_envs(to_reset)
+            sco_obs[[row[i] for i in to_reset]] = reset_obs
+            for i, reset_info in zip(to_reset, reset_infos):
+                self.reset_infos[i] = reset_info
+        return sco_obs, rewards, dones, infos
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        for slot in self.slots:
+            slot.oc_env.close()
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self.slots[i], attr_name) if hasattr(self.slots[i], attr_name) else getattr(self.slots[i].oc_env, attr_name)
+                for i in self._get_indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        for i in self._get_indices(indices):
+            setattr(self.slots[i], attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return [getattr(self.slots[i].oc_env, method_name)(*method_args, **method_kwargs) for i in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        # the 'episode' infos make every env behave as if wrapped by a Monitor
+        return [wrapper_class is Monitor for _ in self._get_indices(indices)]
+
+
+class SharedStepBuffer():
+    """
+    Ring buffer of n_slots vector steps in shared memory: observations, terminal observations,
+    rewards and done flags of all envs, plus the actions of the current step.
+    Created by the main process (name=None), attached to by the shard workers.
+    """
+    def __init__(self, n_envs, obs_size, n_slots, name=None):
+        layout = [("actions", (n_envs,), np.int64),
+                  ("obs", (n_slots, n_envs, obs_size), np.float32),
+                  ("terminal_obs", (n_slots, n_envs, obs_size), np.float32),
+                  ("rewards", (n_slots, n_envs), np.float32),
+                  ("dones", (n_slots, n_envs), np.bool_)]
+        nbytes = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in layout)
+        self.n_envs = n_envs
+        self.obs_size = obs_size
+        self.n_slots = n_slots
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=max(nbytes, 1))
+        self.name = self.shm.name
+        offset = 0
+        for key, shape, dtype in layout:
+            setattr(self, key, np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset))
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    def close(self, unlink=False):
+        self.actions = self.obs = self.terminal_obs = self.rewards = self.dones = None
+        try:
+            self.shm.close()
+        except BufferError: # observations returned to the caller are still referenced
+            pass
+        if unlink:
+            self.shm.unlink()
+
+
+def _shard_worker(remote, parent_remote, env_kwargs_wrapper):
+    parent_remote.close()
+    venv = VecEnvironment(**env_kwargs_wrapper.var)
+    buffer = None
+    rows = None
+    while True:
+        cmd, data = remote.recv()
+        if cmd == "step":
+            # read actions from and write the step results to the shared buffer,
+            # only the (sparse) infos of finished episodes go through the pipe
+            obs, rewards, dones, infos = venv.step(buffer.actions[rows])
+            buffer.obs[data, rows] = obs
+            buffer.rewards[data, rows] = rewards
+            buffer.dones[data, rows] = dones
+            done_infos = []
+            for i in np.flatnonzero(dones):
+                info = infos[i]
+                buffer.terminal_obs[data, rows.start + i] = info.pop("terminal_observation")
+                done_infos.append((int(i), info))
+            remote.send(done_infos)
+        elif cmd == "reset":
+            slot, seeds = data
+            venv._seeds = seeds
+            buffer.obs[slot, rows] = venv.reset()
+            remote.send(None)
+        elif cmd == "reset_envs":
+            remote.send(venv.reset_envs(*data))
+        elif cmd == "step_envs":
+            remote.send(venv.step_envs(*data))
+        elif cmd == "attach":
+            name, n_envs, obs_size, n_slots, offset = data
+            buffer = SharedStepBuffer(n_envs, obs_size, n_slots, name=name)
+            rows = slice(offset, offset + venv.num_envs)
+            remote.send(None)
+        elif cmd == "get_attr":
+            remote.send(venv.get_attr(*data))
+        elif cmd == "set_attr":
+            venv.set_attr(*data)
+            remote.send([None for _ in data[2]])
+        elif cmd == "env_method":
+            method_name, method_args, method_kwargs, indices = data
+            remote.send(venv.env_method(method_name, *method_args, indices=indices, **method_kwargs))
+        elif cmd == "env_is_wrapped":
+            remote.send(venv.env_is_wrapped(*data))
+        elif cmd == "get_spaces":
+            remote.send((venv.observation_space, venv.action_space))
+        elif cmd == "close":
+            venv.close()
+            if buffer is not None:
+                buffer.close()
+            remote.close()
+            break
+        else:
+            raise NotImplementedError(f"`{cmd}` is not implemented in the shard worker")
+
+
+class ShardedVecEnvironment(VecEnv):
+    """
+    Splits n_envs over n_shards worker processes, each hosting a VecEnvironment.
+    E.g. 64 envs as 4 processes x 16 envs instead of 64 single env processes.
+    Takes the same keyword arguments as VecEnvironment, env i is seeded with seed + i.
+    Workers exchange actions, observations, rewards and dones through a SharedStepBuffer, only a step
+    barrier and the infos of finished episodes cross the pipes. The returned observations, rewards and
+    dones are views into the ring buffer and stay valid for n_slots - 1 further steps.
+    """
+    def __init__(self, env_name, n_envs, n_shards, seed=None, start_method=None, silent=False, n_slots=4, **env_kwargs):
+        n_shards = min(n_shards, n_envs)
+        shard_sizes = [n_envs // n_shards + (1 if s < n_envs % n_shards else 0) for s in range(n_shards)]
+        self.shard_offsets = np.cumsum([0] + shard_sizes)
+        if start_method is None:
+            start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+        ctx = mp.get_context(start_method)
+        # the workers have to share the resource tracker of this process: attaching registers the buffer
+        # with the tracker as well (python < 3.13), a worker's own tracker would unlink it when the worker exits
+        resource_tracker.ensure_running()
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(n_shards)])
+        self.processes = []
+        for s, (work_remote, remote) in enumerate(zip(self.work_remotes, self.remotes)):
+            shard_seed = None if seed is None else seed + int(self.shard_offsets[s])
+            shard_kwargs = dict(env_kwargs, env_name=env_name, n_envs=shard_sizes[s], seed=shard_seed, silent=silent or s > 0)
+            process = ctx.Process(target=_shard_worker, args=(work_remote, remote, CloudpickleWrapper(shard_kwargs)), daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+        self.closed = False
+        self.remotes[0].send(("get_spaces", None))
+        observation_space, action_space = self.remotes[0].recv()
+        self.buffer = SharedStepBuffer(n_envs, observation_space.shape[0], max(n_slots, 2))
+        self.slot = 0
+        for s, remote in enumerate(self.remotes):
+            remote.send(("attach", (self.buffer.name, n_envs, observation_space.shape[0], self.buffer.n_slots, int(self.shard_offsets[s]))))
+        for remote in self.remotes:
+            remote.recv()
+        super().__init__(n_envs, observation_space, action_space)
+
+    def _group_by_shard(self, idxs):
+        # shard -> global env indices it holds
+        shard_idxs = {}
+        for i in idxs:
+            s = int(np.searchsorted(self.shard_offsets, i, side="right")) - 1
+            shard_idxs.setdefault(s, []).append(i)
+        return shard_idxs
+
+    def _shard_call(self, cmd, data_func, indices):
+        # sends cmd to the shards holding the given env indices, results are returned in index order
+        idxs = list(self._get_indices(indices))
+        shard_idxs = self._group_by_shard(idxs)
+        for s, global_idxs in shard_idxs.items():
+            self.remotes[s].send((cmd, data_func([i - int(self.shard_offsets[s]) for i in global_idxs])))
+        values = {}
+        for s, global_idxs in shard_idxs.items():
+            values.update(zip(global_idxs, self.remotes[s].recv()))
+        return [values[i] for i in idxs]
+
+    def reset(self):
+        self.slot = (self.slot + 1) % self.buffer.n_slots
+        for s, remote in enumerate(self.remotes):
+            remote.send(("reset", (self.slot, self._seeds[self.shard_offsets[s]:self.shard_offsets[s + 1]])))
+        for remote in self.remotes:
+            remote.recv()
+        self._reset_seeds()
+        return self.buffer.obs[self.slot]
+
+    def reset_envs(self, indices, seeds=None):
+        # resets only the given envs, see VecEnvironment.reset_envs. the feature vectors go through the pipes
+        idxs = list(self._get_indices(indices))
+        if seeds is None:
+            seeds = [None for _ in idxs]
+        seed_of = dict(zip(idxs, seeds))
+        shard_idxs = self._group_by_shard(idxs)
+        for s, global_idxs in shard_idxs.items():
+            local_idxs = [i - int(self.shard_offsets[s]) for i in global_idxs]
+            self.remotes[s].send(("reset_envs", (local_idxs, [seed_of[i] for i in global_idxs])))
+        sco_obs = {}
+        for s, global_idxs in shard_idxs.items():
+            sco_obs.update(zip(global_idxs, self.remotes[s].recv()))
+        return np.stack([sco_obs[i] for i in idxs])
+
+    def step_envs(self, indices, actions):
+        # steps only the given envs, see VecEnvironment.step_envs. the results go through the pipes
+        idxs = list(self._get_indices(indices))
+        action_of = dict(zip(idxs, actions))
+        shard_idxs = self._group_by_shard(idxs)
+        for s, global_idxs in shard_idxs.items():
+            local_idxs = [i - int(self.shard_offsets[s]) for i in global_idxs]
+            self.remotes[s].send(("step_envs", (local_idxs, [action_of[i] for i in global_idxs])))
+        results = {}
+        for s, global_idxs in shard_idxs.items():
+            obs, rewards, dones, infos = self.remotes[s].recv()
+            results.update(zip(global_idxs, zip(obs, rewards, dones, infos)))
+        obs, rewards, dones, infos = zip(*[results[i] for i in idxs])
+        return np.stack(obs), np.array(rewards), np.array(dones), list(infos)
+
+    def step_async(self, actions):
+        self.buffer.actions[:] = actions
+        self.slot = (self.slot + 1) % self.buffer.n_slots
+        for remote in self.remotes:
+            remote.send(("step", self.slot))
+
+    def step_wait(self):
+        infos = [{} for _ in range(self.num_envs)]
+        for s, remote in enumerate(self.remotes):
+            for i, info in remote.recv():
+                i += int(self.shard_offsets[s])
+                info["terminal_observation"] = self.buffer.terminal_obs[self.slot, i]
+                infos[i] = info
+        return self.buffer.obs[self.slot], self.buffer.rewards[self.slot], self.buffer.dones[self.slot], infos
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.buffer.close(unlink=True)
+        self.closed = True
+
+    def get_attr(self, attr_name, indices=None):
+        return self._shard_call("get_attr", lambda local_idxs: (attr_name, local_idxs), indices)
+
+    def set_attr(self, attr_name, value, indices=None):
+        self._shard_call("set_attr", lambda local_idxs: (attr_name, value, local_idxs), indices)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return self._shard_call("env_method", lambda local_idxs: (method_name, method_args, method_kwargs, local_idxs), indices)
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return self._shard_call("env_is_wrapped", lambda local_idxs: (wrapper_class, local_idxs), indices)
@@ -0,0 +1,106 @@
+"""
+Cold start benchmark for scobi: module import time (python -X importtime) and Environment construction time,
+each measured in a fresh interpreter, as every SubprocVecEnv worker and CLI invocation pays them.
+Exits with 1 if a budget is exceeded or a heavy dependency is imported eagerly.
+
+    python scripts/bench_cold_start.py -g Pong --import-budget 400 --env-budget 1500
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+# must not be imported by 'import scobi.core', only on first use
+LAZY_MODULES = ["torch", "stable_baselines3", "PIL", "colormath", "yaml", "matplotlib"]
+
+ENV_SNIPPET = """
+import time
+t = time.perf_counter()
+from scobi import Environment
+env = Environment({env_name!r}, seed=0, focus_dir={focus_dir!r}, silent=True, refresh_yaml=True)
+env.reset(seed=0)
+print(time.perf_counter() - t)
+"""
+
+
+def run_python(args, cwd=None):
+    # the repo root is put on the path of the child, s.t. scobi is found from any working directory
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(REPO_ROOT)] + [p for p in [os.environ.get("PYTHONPATH")] if p]))
+    return subprocess.run([sys.executable] + args, capture_output=True, text=True, cwd=cwd, env=env)
+
+
+def parse_importtime(stderr):
+    # lines look like: 'import time:   self [us] | cumulative | imported package'
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, cumulative_us, name = [x.strip() for x in line.replace("import time:", "|").split("|")]
+        modules.append((name, int(self_us), int(cumulative_us)))
+    return modules
+
+
+def bench_import(module, top):
+    proc = run_python(["-X", "importtime", "-c", "import %s" % module])
+    if proc.returncode != 0:
+        print(proc.stderr)
+        sys.exit(1)
+    modules = parse_importtime(proc.stderr)
+    total_ms = sum(m[1] for m in modules) / 1000
+    print("import %s: %.1f ms" % (module, total_ms))
+    for name, _, cumulative_us in sorted(modules, key=lambda m: -m[2])[:top]:
+        print("  %8.1f ms  %s" % (cumulative_us / 1000, name))
+    loaded = {m[0].split(".")[0] for m in modules}
+    eager = [m for m in LAZY_MODULES if m in loaded]
+    return total_ms, eager
+
+
+def bench_env(env_name, focus_dir, runs):
+    times = []
+    for i in range(runs):
+        # first run may create the focus file, plan cache and color table, later runs hit them
+        t = time.perf_counter()
+        proc = run_python(["-c", ENV_SNIPPET.format(env_name=env_name, focus_dir=focus_dir)], cwd=Path.cwd())
+        wall = time.perf_counter() - t
+        if proc.returncode != 0:
+            print(proc.stdout, proc.stderr)
+            sys.exit(1)
+        env_ms = float(proc.stdout.strip().splitlines()[-1]) * 1000
+        times.append(env_ms)
+        print("import + Environment(%s) + reset, run %i: %.1f ms (process %.1f ms)" % (env_name, i + 1, env_ms, wall * 1000))
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-g", "--game", type=str, default="Pong", help="game to construct")
+    parser.add_argument("--focus-dir", type=str, default="resources/focusfiles", help="focus file directory")
+    parser.add_argument("--runs", type=int, default=3, help="number of fresh processes for the env construction")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to list")
+    parser.add_argument("--import-budget", type=float, default=400, help="budget for 'import scobi.core' in ms")
+    parser.add_argument("--env-budget", type=float, default=1500, help="budget for Environment construction (best run) in ms")
+    parser.add_argument("--skip-env", action="store_true", help="only benchmark the imports")
+    opts = parser.parse_args()
+
+    failed = False
+    import_ms, eager = bench_import("scobi.core", opts.top)
+    if import_ms > opts.import_budget:
+        print("FAIL: import scobi.core took %.1f ms, budget %.1f ms" % (import_ms, opts.import_budget))
+        failed = True
+    if eager:
+        print("FAIL: imported eagerly: %s" % ", ".join(eager))
+        failed = True
+    if not opts.skip_env:
+        env_ms = bench_env("ALE/%s-v5" % opts.game, opts.focus_dir, opts.runs)
+        if env_ms > opts.env_budget:
+            print("FAIL: Environment construction took %.1f ms, budget %.1f ms" % (env_ms, opts.env_budget))
+            failed = True
+    print("FAIL" if failed else "OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import csv
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import argparse
+import numpy as np
+import torch
+from tqdm import tqdm
+from stable_baselines3 import PPO
+
+
+import utils.parser.parser
+from utils.evaluation import make_eval_pool, load_vecnormalize, episode_seeds, run_episodes
+
+
+EVAL_ENV_SEED = 84 # same episodes as eval.py
+MAX_CACHED_POOLS = 4 # env pools kept alive per worker
+FIELDS = ["checkpoint", "game", "seed", "variant", "episodes", "lowest reward", "highest reward", "mean reward",
+          "std reward", "mean steps", "model mtime", "model sha256"]
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _focus_key(ckpt_dir, settings):
+    # checkpoints whose focus files have the same content can share an env pool
+    if settings["variant"] == "rgb":
+        return None
+    focus_file = settings["pruned_ff_name"] or "default_focus_" + settings["env_str"].split("/")[-1] + ".yaml"
+    focus_path = ckpt_dir / focus_file
+    if not focus_path.is_file():
+        return str(ckpt_dir.resolve())
+    return _sha256(focus_path)
+
+
+def _load_table(path):
+    # latest row per checkpoint
+    rows = {}
+    if path.is_file():
+        with open(path, newline="") as file:
+            for row in csv.DictReader(file):
+                rows[row["checkpoint"]] = row
+    return rows
+
+
+def _write_table(path, rows):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, mode="w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        for name in sorted(rows):
+            writer.writerow(rows[name])
+    os.replace(tmp_path, path)
+
+
+def discover_jobs(checkpoints_dir, match, episodes, table, force):
+    """
+    Completed checkpoints (best_model.zip present) below checkpoints_dir and the rows of the ones
+    that are up to date: evaluated with as many episodes from the same model file (same mtime, or same hash).
+    """
+    jobs, up_to_date = [], {}
+    for ckpt_dir in sorted(checkpoints_dir.glob(match)):
+        model_path = ckpt_dir / "best_model.zip"
+        if not model_path.is_file():
+            continue
+        settings = utils.parser.parser.parse_exp_name(ckpt_dir.name)
+        if settings is None:
+            print(f"skipping {ckpt_dir.name}: not a checkpoint folder name")
+            continue
+        mtime = str(model_path.stat().st_mtime_ns)
+        row = table.get(ckpt_dir.name)
+        evaluated = not force and row is not None and row["episodes"] == str(episodes)
+        if evaluated and row["model mtime"] == mtime:
+            continue
+        sha256 = _sha256(model_path)
+        if evaluated and row["model sha256"] == sha256: # touched, not retrained
+            up_to_date[ckpt_dir.name] = dict(row, **{"model mtime": mtime})
+            continue
+        jobs.append(dict(settings, ckpt_dir=ckpt_dir, episodes=episodes, mtime=mtime, sha256=sha256,
+                         focus_key=_focus_key(ckpt_dir, settings)))
+    # checkpoints sharing a pool are scheduled one after the other, s.t. the workers find them cached
+    jobs.sort(key=lambda job: (job["variant"], job["env_str"], str(job["focus_key"]), job["exp_name"]))
+    return jobs, up_to_date
+
+
+# worker state: env pools by (variant, game, focus file, hidden properties)
+_pools = OrderedDict()
+_n_envs = 1
+
+
+def _init_worker(n_envs, n_threads):
+    global _n_envs
+    _n_envs = n_envs
+    torch.set_num_threads(n_threads)
+
+
+def _get_pool(job):
+    key = (job["variant"], job["env_str"], job["focus_key"], job["hide_properties"])
+    if key in _pools:
+        _pools.move_to_end(key)
+        return _pools[key]
+    if len(_pools) >= MAX_CACHED_POOLS:
+        _, evicted = _pools.popitem(last=False)
+        evicted.close()
+    _pools[key] = make_eval_pool(job["variant"], job["env_str"], job["ckpt_dir"], job["pruned_ff_name"],
+                                 job["hide_properties"], EVAL_ENV_SEED, n_envs=_n_envs)
+    return _pools[key]
+
+
+def evaluate_checkpoint(job):
+    ckpt_dir = job["ckpt_dir"]
+    venv = _get_pool(job)
+    if job["variant"] != "rgb":
+        venv = load_vecnormalize(ckpt_dir / "best_vecnormalize.pkl", venv)
+    model = PPO.load(ckpt_dir / "best_model")
+    with torch.inference_mode():
+        rewards, steps = run_episodes(model, venv, episode_seeds(EVAL_ENV_SEED, job["episodes"]))
+    return {"checkpoint": job["exp_name"], "game": job["game"], "seed": job["seed"], "variant": job["variant"],
+            "episodes": job["episodes"], "lowest reward": min(rewards), "highest reward": max(rewards),
+            "mean reward": np.mean(rewards), "std reward": np.std(rewards), "mean steps": np.mean(steps),
+            "model mtime": job["mtime"], "model sha256": job["sha256"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    flag_dictionary = utils.parser.parser.parse_sweep(parser)
+    output = flag_dictionary["output"]
+    n_workers = flag_dictionary["workers"]
+
+    table = _load_table(output)
+    jobs, up_to_date = discover_jobs(flag_dictionary["checkpoints_dir"], flag_dictionary["match"],
+                                     flag_dictionary["times"], table, flag_dictionary["force"])
+    table.update(up_to_date)
+    print(f"{len(jobs)} checkpoints to evaluate, {len(up_to_date)} up to date after a hash check")
+    _write_table(output, table)
+    if not jobs:
+        return
+
+    pbar = tqdm(total=len(jobs), desc="Checkpoints evaluated") if flag_dictionary["progress"] else None
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(jobs)), initializer=_init_worker,
+                             initargs=(flag_dictionary["environments"], n_threads)) as executor, \
+         open(output, mode="a", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        futures = {executor.submit(evaluate_checkpoint, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                row = future.result()
+            except Exception as e: # keep sweeping, the checkpoint stays out of date
+                print(f"{futures[future]['exp_name']} failed: {e!r}")
+                continue
+            # streamed, s.t. finished evaluations survive an interrupted sweep
+            writer.writerow(row)
+            file.flush()
+            table[row["checkpoint"]] = row
+            if pbar is not None:
+                pbar.update(1)
+            else:
+                print(f"{row['checkpoint']}: mean {row['mean reward']:.2f} +/- std {row['std reward']:.2f}")
+    if pbar is not None:
+        pbar.close()
+    _write_table(output, table) # one row per checkpoint
+    print(f"Data saved to {output}")
+
+if __name__ == '__main__':
+    main()
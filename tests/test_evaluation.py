@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ocatari")
+
+from utils.evaluation import make_eval_pool, episode_seeds, run_episodes
+
+ENV_STR = "ALE/Pong-v5"
+SEED = 84
+
+
+class TrackingPolicy:
+    # moves the paddle (y at 1) towards the ball (y at 7): deterministic, but the episodes of different seeds
+    # have different lengths, s.t. envs run out of episodes at different steps
+    def predict(self, obs, deterministic=True):
+        obs = np.asarray(obs)
+        return np.where(obs[:, 7] < obs[:, 1], 2, 3), None
+
+
+def _run(focus_dir, n_envs, episodes):
+    venv = make_eval_pool("scobots", ENV_STR, str(focus_dir), None, False, SEED, n_envs=n_envs)
+    try:
+        return run_episodes(TrackingPolicy(), venv, episode_seeds(SEED, episodes))
+    finally:
+        venv.close()
+
+
+def test_run_episodes_does_not_depend_on_pool_size(tmp_path):
+    # 4 episodes over 3 envs: env 1 runs out of episodes while envs 0 and 2 are still stepped
+    assert _run(tmp_path, 3, 4) == _run(tmp_path, 1, 4)
+
+
+def test_step_envs_subset(tmp_path):
+    venv = make_eval_pool("scobots", ENV_STR, str(tmp_path), None, False, SEED, n_envs=3)
+    try:
+        venv.reset()
+        obs, rewards, dones, infos = venv.step_envs([2], [0])
+        assert obs.shape == (1, venv.observation_space.shape[0])
+        assert rewards.shape == dones.shape == (1,) and len(infos) == 1
+    finally:
+        venv.close()
@@ -21,7 +21,7 @@ from stable_baselines3.common.utils import set_random_seed
 from stable_baselines3.common.vec_env import SubprocVecEnv, VecNormalize, VecTransposeImage
 
 import utils.parser.parser
-from scobi import Environment
+from scobi import Environment, VecEnvironment, ShardedVecEnvironment
 from utils.model_card import ModelCard
 
 MULTIPROCESSING_START_METHOD = "spawn" if os.name == 'nt' else "fork"  # 'nt' == Windows
@@ -157,23 +157,20 @@ def main():
         set_random_seed(seed)
         return _init
 
-    def make_eval_env(rank: int = 0, seed: int = 0, silent=False, refresh=True) -> Callable:
-        def _init() -> gym.Env:
-            env = Environment(flags_dictionary["env"],
-                              seed=seed + rank,
-                              focus_dir=focus_dir,
-                              focus_file=flags_dictionary["pruned_ff_name"],
-                              hide_properties=flags_dictionary["hide_properties"],
-                              silent=silent,
-                              reward=0, #always env reward for eval
-                              refresh_yaml=refresh,
-                              hud=flags_dictionary["hud"])
-            env = Monitor(env)
-            env.reset(seed=seed + rank)
-            return env
-
+    def make_scobi_vec_env(n: int, seed: int = 0, reward: int = 0, episodic_life=False, n_shards: int = 1):
+        env_kwargs = dict(seed=seed,
+                          focus_dir=focus_dir,
+                          focus_file=flags_dictionary["pruned_ff_name"],
+                          hide_properties=flags_dictionary["hide_properties"],
+                          silent=True,
+                          reward=reward,
+                          refresh_yaml=False,
+                          hud=flags_dictionary["hud"],
+                          episodic_life=episodic_life)
         set_random_seed(seed)
-        return _init
+        if n_shards > 1:
+            return ShardedVecEnvironment(flags_dictionary["env"], n, n_shards, start_method=MULTIPROCESSING_START_METHOD, **env_kwargs)
+        return VecEnvironment(flags_dictionary["env"], n, **env_kwargs)
 
     # preprocessing based on atari wrapper of the openai baseline implementation (https://github.com/openai/baselines/blob/master/baselines/ppo1/run_atari.py)
     if flags_dictionary["rgb"]:
@@ -191,8 +188,9 @@ def main():
         check_env(monitor.env)
         del monitor
         # silent init and dont refresh default yaml file because it causes spam and issues with multiprocessing
-        eval_env = VecNormalize(SubprocVecEnv([make_eval_env(rank=i, seed=eval_env_seed, silent=True, refresh=False) for i in range(n_eval_envs)], start_method=MULTIPROCESSING_START_METHOD), norm_reward=False, training=False)
-        train_env = VecNormalize(SubprocVecEnv([make_env(rank=i, seed=int(flags_dictionary["seed"]), silent=True, refresh=False) for i in range(n_envs)], start_method=MULTIPROCESSING_START_METHOD), norm_reward=False)
+        # all envs of a vec env share one focus, their features are computed in a single batched pass
+        eval_env = VecNormalize(make_scobi_vec_env(n_eval_envs, seed=eval_env_seed, reward=0), norm_reward=False, training=False) #always env reward for eval
+        train_env = VecNormalize(make_scobi_vec_env(n_envs, seed=int(flags_dictionary["seed"]), reward=flags_dictionary["reward_mode"], episodic_life=True, n_shards=flags_dictionary["shards"]), norm_reward=False)
 
     rtpt_iters = training_timestamps // rtpt_frequency
     save_bm = SaveBestModelCallback(ckpt_path, rgb=flags_dictionary["rgb_exp"])
@@ -0,0 +1,122 @@
+"""
+Episode evaluation over a pool of environments.
+Episode i always starts from seed base_seed + i, no matter which env of the pool runs it, s.t. the
+results do not depend on the pool size. model.predict is called once per step for all live envs.
+"""
+import numpy as np
+from stable_baselines3.common.atari_wrappers import WarpFrame
+from stable_baselines3.common.env_util import make_vec_env
+from stable_baselines3.common.vec_env import VecNormalize, DummyVecEnv
+from scobi import Environment, VecEnvironment, ShardedVecEnvironment
+
+
+def make_eval_env(variant, env_str, ff_file_path, pruned_ff_name, hide_properties, vecnorm_path, seed, n_envs=1, n_shards=1, headless=True):
+    """
+    Pool of n_envs evaluation envs with the frozen VecNormalize statistics of the checkpoint (scobi variants).
+    Headless scobi pools are VecEnvironments (split over n_shards processes if n_shards > 1), rendered ones
+    hold Environments with draw_features, s.t. their overlays can be shown.
+    """
+    venv = make_eval_pool(variant, env_str, ff_file_path, pruned_ff_name, hide_properties, seed, n_envs, n_shards, headless)
+    if variant == "rgb":
+        return venv
+    return load_vecnormalize(vecnorm_path, venv)
+
+
+def make_eval_pool(variant, env_str, ff_file_path, pruned_ff_name, hide_properties, seed, n_envs=1, n_shards=1, headless=True):
+    # env pool of make_eval_env without the normalization, can be reused for checkpoints with the same focus file
+    if variant == "rgb":
+        return make_vec_env(env_str, n_envs=n_envs, seed=seed, wrapper_class=WarpFrame)
+    env_kwargs = {"focus_dir": ff_file_path, "focus_file": pruned_ff_name, "hide_properties": hide_properties,
+                  "reward": 0} #env reward only for evaluation
+    if not headless:
+        envs = [Environment(env_str, draw_features=True, **env_kwargs) for _ in range(n_envs)]
+        return DummyVecEnv([lambda env=env: env for env in envs])
+    if n_shards > 1:
+        return ShardedVecEnvironment(env_str, n_envs, n_shards, seed=seed, **env_kwargs)
+    return VecEnvironment(env_str, n_envs, seed=seed, **env_kwargs)
+
+
+def load_vecnormalize(vecnorm_path, venv):
+    # frozen normalization statistics of a checkpoint around venv
+    venv = VecNormalize.load(vecnorm_path, venv)
+    venv.training = False
+    venv.norm_reward = False
+    return venv
+
+
+def episode_seeds(base_seed, episodes):
+    return [base_seed + i for i in range(episodes)]
+
+
+def reset_envs(venv, idxs, seeds):
+    # seeded reset of single envs of a (VecNormalize wrapped) scobi vec env or DummyVecEnv, returns their observations
+    inner = venv.venv if isinstance(venv, VecNormalize) else venv
+    if hasattr(inner, "reset_envs"):
+        obs = inner.reset_envs(idxs, seeds)
+    else:
+        obs = np.stack([inner.envs[i].reset(seed=seed)[0] for i, seed in zip(idxs, seeds)])
+    if isinstance(venv, VecNormalize):
+        obs = venv.normalize_obs(obs)
+    return obs
+
+
+def step_envs(venv, idxs, actions):
+    # steps only the envs idxs of a (VecNormalize wrapped) scobi vec env or DummyVecEnv, returns their observations, rewards and dones
+    inner = venv.venv if isinstance(venv, VecNormalize) else venv
+    if hasattr(inner, "step_envs"):
+        obs, reward, done, _ = inner.step_envs(idxs, actions)
+    else: # finished envs are not reset, run_episodes resets them when they start their next episode
+        results = [inner.envs[i].step(action) for i, action in zip(idxs, actions)]
+        obs = np.stack([r[0] for r in results])
+        reward = np.array([r[1] for r in results], dtype=np.float32)
+        done = np.array([r[2] or r[3] for r in results])
+    if isinstance(venv, VecNormalize):
+        obs = venv.normalize_obs(obs)
+        reward = venv.normalize_reward(reward)
+    return obs, reward, done
+
+
+def run_episodes(model, venv, seeds, pbar=None):
+    """
+    Runs len(seeds) episodes spread over the envs of venv, returns the rewards and steps per episode (in episode order).
+    Envs without episodes left are no longer stepped.
+    """
+    n_envs = venv.num_envs
+    n_episodes = len(seeds)
+    rewards = [0.0 for _ in range(n_episodes)]
+    steps = [0 for _ in range(n_episodes)]
+    # episode each env is running, None once no episodes are left for it
+    episode_of = [i if i < n_episodes else None for i in range(n_envs)]
+    next_episode = min(n_envs, n_episodes)
+    obs = venv.reset()
+    obs[:next_episode] = reset_envs(venv, list(range(next_episode)), seeds[:next_episode])
+    actions = np.zeros((n_envs,) + venv.action_space.shape, dtype=venv.action_space.dtype)
+    finished_episodes = 0
+    while finished_episodes < n_episodes:
+        live = [i for i in range(n_envs) if episode_of[i] is not None]
+        actions[live], _ = model.predict(obs[live], deterministic=True)
+        if len(live) == n_envs:
+            obs, reward, done, _ = venv.step(actions)
+        else: # rows of the results are in the order of live
+            obs[live], reward_live, done_live = step_envs(venv, live, actions[live])
+            reward, done = np.zeros(n_envs), np.zeros(n_envs, dtype=bool)
+            reward[live], done[live] = reward_live, done_live
+        to_reset, reset_seeds = [], []
+        for i in live:
+            episode = episode_of[i]
+            rewards[episode] += float(reward[i])
+            steps[episode] += 1
+            if done[i]:
+                finished_episodes += 1
+                if pbar is not None:
+                    pbar.update(1)
+                if next_episode < n_episodes:
+                    episode_of[i] = next_episode
+                    to_reset.append(i)
+                    reset_seeds.append(seeds[next_episode])
+                    next_episode += 1
+                else:
+                    episode_of[i] = None
+        if to_reset:
+            obs[to_reset] = reset_envs(venv, to_reset, reset_seeds)
+    return rewards, steps
@@ -22,6 +22,7 @@ def parse_train():
     parser.add_argument("--rgb", action="store_true", help="rgb observation space")
     parser.add_argument("--progress", action="store_true", help="display a progress bar of the training process")
     parser.add_argument("--hud", action="store_true", help="use HUD objects")
+    parser.add_argument("--shards", type=int, default=1, help="number of processes the environments are split over (default: all in one process)")
 
     opts = parser.parse_args()
 
@@ -81,7 +82,8 @@ def parse_train():
         "rgb": opts.rgb,
         "reward": opts.reward,
         "progress": opts.progress,
-        "hud": opts.hud
+        "hud": opts.hud,
+        "shards": opts.shards
     }
 
 
@@ -104,6 +106,7 @@ def render_parser():
     parser.add_argument("--print-reward", action="store_true", help="display the reward in the console (if not 0)")
     parser.add_argument("--viper", nargs="?", const=True, default=False, help="evaluate the extracted viper tree instead of a checkpoint")
     parser.add_argument("--hud", action="store_true", help="use HUD objects")
+    parser.add_argument("--async-overlays", action="store_true", help="draw the feature overlays in a background thread")
     opts = parser.parse_args()
 
     env_str = "ALE/" + opts.game +"-v5"
@@ -157,7 +160,8 @@ def render_parser():
         "nb_frames": opts.nb_frames,
         "print_reward": opts.print_reward,
         "viper": opts.viper,
-        "hud": opts.hud
+        "hud": opts.hud,
+        "async_overlays": opts.async_overlays
     }
 
 
@@ -178,6 +182,9 @@ def parse_eval(parser):
     parser.add_argument("--rgb", required= False, action="store_true", help="rgb observation space")
     parser.add_argument("--viper", nargs="?", const=True, default=False, help="evaluate the extracted viper tree instead of a checkpoint")
     parser.add_argument("--hud", action="store_true", help="use HUD objects")
+    parser.add_argument("-env", "--environments", type=int, default=1, help="number of environments the episodes are spread over")
+    parser.add_argument("--shards", type=int, default=1, help="number of processes the environments are split over (default: all in one process)")
+    parser.add_argument("--render", action="store_true", help="draw the feature overlays and show the first frame (slower, headless if omitted)")
     opts = parser.parse_args()
 
     env_str = "ALE/" + opts.game +"-v5"
@@ -230,7 +237,58 @@ def parse_eval(parser):
         "progress": opts.progress,
         "rgb": opts.rgb,
         "viper": opts.viper,
-        "hud": opts.hud
+        "hud": opts.hud,
+        "headless": not opts.render,
+        "environments": opts.environments,
+        "shards": opts.shards
+    }
+
+
+def parse_sweep(parser):
+    parser.add_argument("-t", "--times", type=int, required=True,
+                        help="number of episodes to eval per checkpoint")
+    parser.add_argument("-c", "--checkpoints", type=str, default="resources/checkpoints",
+                        help="directory containing the checkpoint folders")
+    parser.add_argument("-m", "--match", type=str, default="*",
+                        help="only evaluate checkpoint folders matching this glob pattern (e.g. 'Pong_seed*')")
+    parser.add_argument("-o", "--output", type=str, required=False,
+                        help="consolidated results table (default: 'sweep_evaluation.csv' in the checkpoints directory)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of evaluation processes")
+    parser.add_argument("-env", "--environments", type=int, default=1, help="number of environments the episodes of a checkpoint are spread over")
+    parser.add_argument("--force", action="store_true", help="re-evaluate checkpoints whose results are up to date")
+    parser.add_argument("--progress", action="store_true", help="display a progress bar of the sweep")
+    opts = parser.parse_args()
+
+    checkpoints_dir = Path(opts.checkpoints)
+    return {
+        "checkpoints_dir": checkpoints_dir,
+        "match": opts.match,
+        "output": Path(opts.output) if opts.output else checkpoints_dir / "sweep_evaluation.csv",
+        "times": opts.times,
+        "workers": max(1, opts.workers or 1),
+        "environments": opts.environments,
+        "force": opts.force,
+        "progress": opts.progress
+    }
+
+
+def parse_exp_name(exp_name):
+    # settings of a checkpoint folder name as built by parse_train, None if it is not one
+    match = re.fullmatch(r"(?P<game>[A-Za-z]+)_seed(?P<seed>\d+)(?P<settings>(?:_[a-z-]+)*?)(?P<version>-n\d+)?", exp_name)
+    if match is None:
+        return None
+    settings = match.group("settings").split("_")[1:]
+    game = match.group("game")
+    pruned = "pruned" in settings or "pruned-external" in settings
+    variant = "rgb" if "rgb" in settings else "iscobots" if pruned else "scobots"
+    return {
+        "exp_name": exp_name,
+        "game": game,
+        "seed": int(match.group("seed")),
+        "env_str": "ALE/" + game + "-v5",
+        "variant": variant,
+        "pruned_ff_name": f"pruned_{game.lower()}.yaml" if pruned else None,
+        "hide_properties": "excludeproperties" in settings
     }
 
 
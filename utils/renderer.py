@@ -171,6 +171,11 @@ class Renderer:
                 elif (event.key,) in self.keys2actions.keys():  # env action
                     self.current_keys_down.add(event.key)
 
+                elif event.key == pygame.K_o:  # 'O': print overlay metrics, unless the game uses it
+                    metrics = None if self.rgb_agent else self.env.overlay_metrics
+                    if metrics is not None:
+                        print(", ".join("%s: %i" % (k, v) for k, v in metrics.items()))
+
                 elif pygame.K_0 <= event.key <= pygame.K_9:  # enter digit
                     char = str(event.key - pygame.K_0)
                     if self.active_cell_idx is not None:
@@ -0,0 +1,100 @@
+"""
+Decision trees compiled into flat arrays.
+A fitted sklearn DecisionTreeClassifier becomes feature/threshold/left/right/value arrays over its nodes,
+batches are evaluated branch-free level by level and single rows by a generated if/else function,
+both without sklearn's per call validation. Compiled .viper files are cached next to them as .npz.
+"""
+from pathlib import Path
+
+import numpy as np
+from joblib import load
+
+MAX_GENERATED_DEPTH = 50
+
+
+class CompiledTree:
+    def __init__(self, feature, threshold, left, right, value, depth):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value # predicted label per node
+        self.depth = depth
+        # very deep trees would exceed python's nesting limit, they take the batch path
+        self._predict_row = _generate_row_function(self) if depth <= MAX_GENERATED_DEPTH else None
+
+    def predict(self, X):
+        """
+        Labels (n,) of the rows of X (n, F), same as the sklearn tree: features are compared as float32.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        if X.shape[0] == 1 and self._predict_row is not None:
+            return self.value[[self._predict_row(X[0].tolist())]]
+        rows = np.arange(X.shape[0])
+        node = np.zeros(X.shape[0], dtype=np.intp)
+        for _ in range(self.depth): # leaves point to themselves
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+        return self.value[node]
+
+    def save(self, path):
+        np.savez(path, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+                 value=self.value, depth=self.depth)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["feature"], f["threshold"], f["left"], f["right"], f["value"], int(f["depth"]))
+
+
+def compile_tree(dt):
+    # CompiledTree of a fitted DecisionTreeClassifier (single output)
+    tree = dt.tree_
+    nodes = np.arange(tree.node_count)
+    is_leaf = tree.children_left < 0
+    feature = np.where(is_leaf, 0, tree.feature).astype(np.intp)
+    threshold = np.where(is_leaf, np.inf, tree.threshold).astype(np.float32)
+    # sklearn compares float32 features with float64 thresholds, x <= t is the same as x <= float32(t) rounded down
+    lower = threshold > tree.threshold
+    threshold[lower] = np.nextafter(threshold[lower], np.float32(-np.inf))
+    left = np.where(is_leaf, nodes, tree.children_left).astype(np.intp)
+    right = np.where(is_leaf, nodes, tree.children_right).astype(np.intp)
+    value = dt.classes_[np.argmax(tree.value[:, 0, :], axis=1)]
+    return CompiledTree(feature, threshold, left, right, value, int(tree.max_depth))
+
+
+def _generate_row_function(ct):
+    # python function row -> leaf node of the tree, nested if/else over the flat arrays
+    lines = ["def predict_row(x):"]
+    stack = [(0, 1)]
+    while stack:
+        node, indent = stack.pop()
+        pad = "    " * indent
+        if node == "else":
+            lines.append(pad + "else:")
+            continue
+        if ct.left[node] == node:
+            lines.append(pad + "return %d" % node)
+            continue
+        lines.append(pad + "if x[%d] <= %r:" % (ct.feature[node], float(ct.threshold[node])))
+        # popped in reverse: left subtree, else, right subtree
+        stack.append((ct.right[node], indent + 1))
+        stack.append(("else", indent))
+        stack.append((ct.left[node], indent + 1))
+    namespace = {}
+    exec(compile("\n".join(lines), "<compiled tree>", "exec"), namespace)
+    return namespace["predict_row"]
+
+
+def load_compiled_tree(viper_path):
+    # compiled tree of a .viper file, (re)compiled into the .npz next to it if that is missing or older
+    viper_path = Path(viper_path)
+    cache_path = viper_path.with_suffix(".npz")
+    if cache_path.is_file() and cache_path.stat().st_mtime >= viper_path.stat().st_mtime:
+        return CompiledTree.load(cache_path)
+    ct = compile_tree(load(viper_path))
+    try:
+        ct.save(cache_path)
+    except OSError: # e.g. read-only extraction folder, compiled again next time
+        pass
+    return ct
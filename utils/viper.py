@@ -1,6 +1,6 @@
 import time
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
-from operator import itemgetter
 from pathlib import Path
 
 import numpy as np
@@ -11,60 +11,255 @@ from sklearn.tree import DecisionTreeClassifier
 from stable_baselines3 import PPO
 from tqdm import tqdm
 
+from utils.evaluation import make_eval_pool, load_vecnormalize, episode_seeds, run_episodes
+from utils.tree_kernel import compile_tree
+
 # from viperoc repository
-cuda = torch.device("cuda")
 class LogProbQ:
-    def __init__(self, stochastic_pol: PPO, env: Env):
+    def __init__(self, stochastic_pol: PPO, env: Env, batch_size: int=4096):
         self.pol = stochastic_pol
         self.env = env
+        self.batch_size = batch_size # states per forward pass
 
-    def q(self, s):
-        s = torch.Tensor(s).to(cuda)
-        s_repeat = s.repeat(self.env.action_space.n,1)
+    def q(self, S):
+        # log probs (n, n_actions) of all actions in the states S (n, F), on the device of the policy
+        S = torch.as_tensor(np.asarray(S), dtype=torch.float32, device=self.pol.policy.device)
+        log_probs = []
         with torch.no_grad():
-            _, s_a_log_probs, _ = self.pol.policy.evaluate_actions(s_repeat, torch.arange(self.env.action_space.n).reshape(-1, 1).to(cuda))
-        return s_a_log_probs
+            for chunk in S.split(self.batch_size):
+                # one pass per chunk, the (normalized) logits are the log probs of all actions
+                log_probs.append(self.pol.policy.get_distribution(chunk).distribution.logits)
+        return torch.cat(log_probs)
+
+    def get_disagreement_cost(self, S):
+        # weights (n,) of the states S
+        log_prob = self.q(S)
+        return (log_prob.mean(dim=1) - log_prob.min(dim=1).values).cpu().numpy()
+
+
+class AggregatedDataset:
+    """
+    States, oracle actions and weights aggregated over the DAgger iterations. Rows are appended into
+    preallocated arrays whose capacity doubles when full, s.t. every row is copied amortized O(1) times.
+    With path, the arrays are memory-mapped files in that directory (grown in place), s.t. the dataset
+    does not have to fit into RAM. states, actions and weights are views of the first n rows.
+    """
+    def __init__(self, capacity: int=65_536, path=None):
+        self.capacity = max(1, capacity)
+        self.path = None if path is None else Path(path)
+        self.n = 0
+        self.arrays = None
+
+    def _open(self, name, shape, dtype, capacity):
+        if self.path is None:
+            return np.empty((capacity,) + shape, dtype=dtype)
+        fpath = self.path / (name + ".dat")
+        with open(fpath, "r+b" if fpath.exists() and self.arrays is not None else "wb") as f:
+            f.truncate(capacity * int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize)
+        return np.memmap(fpath, dtype=dtype, mode="r+", shape=(capacity,) + shape)
+
+    def _allocate(self, capacity):
+        if self.path is not None:
+            self.path.mkdir(parents=True, exist_ok=True)
+        arrays = {}
+        for name, (shape, dtype) in self.layout.items():
+            arrays[name] = self._open(name, shape, dtype, capacity)
+            if self.path is None and self.arrays is not None: # memmaps keep their rows when the file grows
+                arrays[name][:self.n] = self.arrays[name][:self.n]
+        self.arrays = arrays
+        self.capacity = capacity
+
+    def append(self, S, A, weights=None):
+        S, A = np.asarray(S), np.asarray(A)
+        weights = np.ones(len(S), dtype=np.float32) if weights is None else np.asarray(weights)
+        if self.arrays is None:
+            self.layout = {"states": (S.shape[1:], S.dtype), "actions": (A.shape[1:], A.dtype),
+                           "weights": (weights.shape[1:], weights.dtype)}
+            self._allocate(max(self.capacity, len(S)))
+        elif self.n + len(S) > self.capacity:
+            self._allocate(max(2 * self.capacity, self.n + len(S)))
+        end = self.n + len(S)
+        self.arrays["states"][self.n:end] = S
+        self.arrays["actions"][self.n:end] = A
+        self.arrays["weights"][self.n:end] = weights
+        self.n = end
+
+    def __getstate__(self):
+        # memory-mapped datasets are reopened read-only from their files, others are sent as their first n rows
+        state = dict(self.__dict__)
+        if self.arrays is not None:
+            if self.path is not None:
+                for a in self.arrays.values():
+                    a.flush()
+                state["arrays"] = None
+            else:
+                state["arrays"] = {name: a[:self.n] for name, a in self.arrays.items()}
+                state["capacity"] = self.n
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None and self.arrays is None and self.n > 0:
+            self.arrays = {name: np.memmap(self.path / (name + ".dat"), dtype=dtype, mode="r", shape=(self.capacity,) + shape)
+                           for name, (shape, dtype) in self.layout.items()}
+
+    @property
+    def states(self):
+        return self.arrays["states"][:self.n]
+
+    @property
+    def actions(self):
+        return self.arrays["actions"][:self.n]
+
+    @property
+    def weights(self):
+        return self.arrays["weights"][:self.n]
+
+
+class _TreePolicy:
+    def __init__(self, tree):
+        self.tree = compile_tree(tree)
+
+    def predict(self, obs, deterministic=True):
+        return self.tree.predict(obs), None
+
+
+# scorer worker state: env pool and episode seeds, built once per process, and the dataset of a sweep
+_scorer_env = None
+_scorer_seeds = None
+_sweep_dataset = None
+
+
+def _init_scorer(env_str, focus_dir, pruned_ff_name, vecnorm_path, n_envs, seeds):
+    global _scorer_env, _scorer_seeds
+    _scorer_env = load_vecnormalize(vecnorm_path, make_eval_pool("scobots", env_str, focus_dir, pruned_ff_name, False,
+                                                                 seeds[0], n_envs=n_envs))
+    _scorer_seeds = seeds
+
+
+def _score_tree(tree):
+    rewards, _ = run_episodes(_TreePolicy(tree), _scorer_env, _scorer_seeds)
+    return float(np.mean(rewards))
+
+
+def _init_sweep(scorer_args, dataset):
+    # sent once per worker, memory-mapped datasets only as their path
+    global _sweep_dataset
+    _init_scorer(*scorer_args)
+    _sweep_dataset = dataset
+
+
+def _fit_and_score(params):
+    tree = DecisionTreeClassifier(**params)
+    tree.fit(_sweep_dataset.states, _sweep_dataset.actions, _sweep_dataset.weights)
+    return {"params": params, "leaves": int(tree.get_n_leaves()), "depth": int(tree.get_depth()),
+            "reward": _score_tree(tree), "tree": tree}
 
-    def get_disagreement_cost(self, s):
-        log_prob = self.q(s)
-        return log_prob.mean() - log_prob.min()
+
+class TreeScorer:
+    """
+    Scores trees by their mean reward over the same episodes (env seeds seed + i) in a process pool,
+    every worker builds its env pool once. submit returns futures.
+    """
+    def __init__(self, env_str, focus_dir, pruned_ff_name, vecnorm_path, episodes: int=5, n_workers: int=2, n_envs: int=1, seed: int=84):
+        self.n_workers = n_workers
+        self.initargs = (env_str, focus_dir, pruned_ff_name, vecnorm_path, n_envs, episode_seeds(seed, episodes))
+        self.executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_scorer, initargs=self.initargs)
+
+    def submit(self, tree):
+        return self.executor.submit(_score_tree, tree)
+
+    def sweep(self, param_grid, dataset):
+        """
+        Fits DecisionTreeClassifier(**params) per params on the (weighted) dataset and scores it, in a pool of its own
+        whose workers receive the dataset once, only the params are sent per tree. Returns the results in param_grid order.
+        """
+        n_workers = max(1, min(self.n_workers, len(param_grid)))
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_sweep, initargs=(self.initargs, dataset)) as executor:
+            return list(executor.map(_fit_and_score, param_grid))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def pareto_front(results):
+    # results (dicts with leaves and reward) no other result beats with fewer or as many leaves, smallest first
+    front = []
+    for result in sorted(results, key=lambda r: (r["leaves"], -r["reward"])):
+        if not front or result["reward"] > front[-1]["reward"]:
+            front.append(result)
+    return front
+
+
+def load_recorded(path):
+    # recorded observations and oracle actions (obs.npy, acts.npy) in path, memory-mapped
+    path = Path(path)
+    return np.load(path / "obs.npy", mmap_mode="r"), np.load(path / "acts.npy", mmap_mode="r")
 
 
 class DecisionTreeExtractor: #Dagger
-    def __init__(self, model: PPO, dtpolicy: DecisionTreeClassifier, env: Env, data_per_iter: int=30_000):
+    def __init__(self, model: PPO, dtpolicy: DecisionTreeClassifier, env: Env, data_per_iter: int=30_000, dataset_path=None,
+                 scorer: TreeScorer=None, top_k=None):
         self.model = model
-        self.env = env # is vectorized
+        self.env = env # is vectorized, the data_per_iter steps are split over its envs
         self.data_per_iter = data_per_iter
         self.dt = dtpolicy
+        self.dataset_path = dataset_path # memory-map the aggregated dataset into this directory
+        self.scorer = scorer # scores the trees in parallel, otherwise by the reward of their rollouts
+        self.top_k = top_k # number of best trees kept, all if None
 
-    def collect_data(self):
-        S, A = [], []
+    def _rollout(self, predict, n=None, progress=False):
+        """
+        Steps all envs of self.env with the batched actions predict(s) until n (default: data_per_iter) observations are collected.
+        Returns the observations (n, F), actions and the rewards of the episodes finished on the way.
+        """
+        n = self.data_per_iter if n is None else n
+        n_envs = self.env.num_envs
+        n_steps = -(-n // n_envs)
         s = self.env.reset()
-        for i in tqdm(range(self.data_per_iter)):
-            action = self.model.predict(s, deterministic=True)[0]
-            S.append(s[0]) #unvec
-            A.append(action[0]) #unvec
-            s, _, done, _ = self.env.step(action)
-            if done:
-                s = self.env.reset()
-        return np.array(S), np.array(A)
-
-    def collect_data_dt(self,):
-        S = []
+        S = np.empty((n_steps, n_envs) + s.shape[1:], dtype=s.dtype)
+        A = np.empty((n_steps, n_envs), dtype=np.int64)
+        ep_rewards = np.zeros(n_envs)
         episodes = []
-        ep_reward = 0
-        s = self.env.reset()
-        for i in range(self.data_per_iter):
-            action = self.dt.predict(s.reshape(1, -1))
-            S.append(s[0]) #unvec
-            s, r, done, infos = self.env.step(action)
-            ep_reward += r
-            if done:
-                s = self.env.reset()
-                episodes.append(ep_reward)
-                ep_reward = 0
+        for t in tqdm(range(n_steps), disable=not progress):
+            S[t] = s
+            A[t] = predict(s)
+            s, r, done, _ = self.env.step(A[t]) # finished envs are reset by the vec env
+            ep_rewards += r
+            episodes += ep_rewards[done].tolist()
+            ep_rewards[done] = 0
         if len(episodes) < 1:
-            episodes.append(ep_reward)
+            episodes = ep_rewards.tolist()
+        S = S.reshape((n_steps * n_envs,) + S.shape[2:])[:n]
+        A = A.reshape(-1)[:n]
+        return S, A, episodes
+
+    def add_recorded(self, D, datasets, weigh=None, chunk_size: int=65_536):
+        # appends recorded (observations, oracle actions) pairs, e.g. from load_recorded, chunk by chunk
+        for S, A in datasets:
+            for i in range(0, len(S), chunk_size):
+                S_chunk, A_chunk = np.array(S[i:i + chunk_size]), np.array(A[i:i + chunk_size]) # read into RAM, one chunk at a time
+                D.append(S_chunk, A_chunk, None if weigh is None else weigh(S_chunk))
+
+    def add_initial(self, D, datasets, weigh=None):
+        # recorded pairs, topped up with oracle rollouts to at least data_per_iter rows
+        if datasets:
+            self.add_recorded(D, datasets, weigh)
+        if D.n < self.data_per_iter:
+            S, A = self.collect_data(self.data_per_iter - D.n)
+            D.append(S, A, None if weigh is None else weigh(S))
+
+    def _new_dataset(self, nb_iter, datasets):
+        # room for the initial data and the rollouts of every iteration
+        recorded = sum(len(S) for S, _ in datasets) if datasets else 0
+        return AggregatedDataset(max(recorded, self.data_per_iter) + nb_iter * self.data_per_iter, self.dataset_path)
+
+    def collect_data(self, n=None):
+        S, A, _ = self._rollout(lambda s: self.model.predict(s, deterministic=True)[0], n, progress=True)
+        return S, A
+
+    def collect_data_dt(self,):
+        S, _, episodes = self._rollout(compile_tree(self.dt).predict)
         return S, np.mean(episodes)
 
     def fit_DT(self, S, A):
@@ -73,84 +268,156 @@ class DecisionTreeExtractor: #Dagger
         acc = self.dt.score(S, A)
         return acc
 
-    def imitate(self, nb_iter: int):
+    def imitate(self, nb_iter: int, datasets=None):
+        """
+        datasets: recorded (observations, oracle actions) pairs used as the initial dataset instead of fresh oracle rollouts,
+        recordings of less than data_per_iter rows are topped up with oracle rollouts.
+        """
         start_time = time.time()
-        self.list_acc, self.list_eval, self.list_dt, self.times = [], [], [], []
-        DS, DA = self.collect_data()
-        acc_dt = self.fit_DT(DS, DA)
+        self.list_acc, self.list_eval, self.times = [], [], []
+        self.trees, self.scores, self.pending = {}, {}, {}
+        self.dataset = self._new_dataset(nb_iter, datasets)
+        D = self.dataset
+        self.add_initial(D, datasets)
+        acc_dt = self.fit_DT(D.states, D.actions)
         S_dt, eval_dt = self.collect_data_dt()
         self.times.append(time.time()-start_time)
 
         print("Accuracy: {} - Evaluation: {}".format(acc_dt, eval_dt))
-        self.list_dt.append(deepcopy(self.dt))
         self.list_acc.append(acc_dt)
         self.list_eval.append(eval_dt)
-        DS = np.concatenate((DS, S_dt))
-        DA = np.concatenate((DA, self.model.predict(S_dt)[0]))
+        self.add_tree()
+        D.append(S_dt, self.model.predict(S_dt)[0])
 
         for _ in range(nb_iter - 1):
-            acc_dt = self.fit_DT(DS, DA)
+            acc_dt = self.fit_DT(D.states, D.actions)
             S_dt, eval_dt = self.collect_data_dt()
             self.times.append(time.time()-start_time)
 
             print("Accuracy: {} - Evaluation: {}".format(acc_dt, eval_dt))
-            self.list_dt.append(deepcopy(self.dt))
             self.list_acc.append(acc_dt)
             self.list_eval.append(eval_dt)
-            DS = np.concatenate((DS, S_dt))
-            DA = np.concatenate((DA, self.model.predict(S_dt)[0]))
+            self.add_tree()
+            D.append(S_dt, self.model.predict(S_dt)[0])
+
+    def add_tree(self):
+        # candidate tree of the current iteration
+        j = len(self.list_eval) - 1
+        tree = deepcopy(self.dt)
+        if self.scorer is None:
+            self._keep(j, tree, self.list_eval[j])
+        else:
+            self.pending[j] = (tree, self.scorer.submit(tree))
+            self.collect_scores()
+
+    def collect_scores(self, wait=False):
+        for j, (tree, future) in list(self.pending.items()):
+            if wait or future.done():
+                del self.pending[j]
+                self._keep(j, tree, future.result())
+
+    def _keep(self, j, tree, score):
+        self.scores[j] = score
+        self.trees[j] = tree
+        if self.top_k is not None and len(self.trees) > self.top_k:
+            del self.trees[min(self.trees, key=lambda i: (self.scores[i], -i))] # on ties the earlier tree stays
 
     def save_best_tree(self, out_path):
+        self.collect_scores(wait=True)
         trees_path = out_path / Path("viper_trees")
         trees_path.mkdir(parents=True, exist_ok=True)
 
-        for j, tree in enumerate(self.list_dt):
-            fpath = "Tree-%s_%s.viper" % (j, self.list_eval[j])
+        for j, tree in self.trees.items():
+            fpath = "Tree-%s_%s.viper" % (j, self.scores[j])
             dump(tree, trees_path / fpath)
 
-        index, element = max(enumerate(self.list_eval), key=itemgetter(1))
-        self.best_dt = self.list_dt[index]
-        best_fpath = "Tree-"+str(element) + "_best.viper"
+        index = max(self.trees, key=lambda j: (self.scores[j], -j))
+        self.best_dt = self.trees[index]
+        best_fpath = "Tree-"+str(self.scores[index]) + "_best.viper"
         dump(self.best_dt, out_path / best_fpath)
 
+    def sweep(self, param_grid):
+        """
+        Fits a tree per parameter dict (e.g. {"max_depth": 3}) on the aggregated dataset in processes of the scorer.
+        Returns the results (params, leaves, depth, reward, tree) and their reward-versus-size Pareto front.
+        """
+        results = self.scorer.sweep(param_grid, self.dataset)
+        return results, pareto_front(results)
+
+def plateaued(values, patience, tol=0.0):
+    # no value of the last patience iterations improved on the best before them by more than tol
+    return len(values) > patience and max(values[-patience:]) <= max(values[:-patience]) + tol
+
 
 class VIPER(DecisionTreeExtractor):
-    def __init__(self, model: PPO, dtpolicy: DecisionTreeClassifier, env: Env, rtpt, data_per_iter: int=30_000):
-        super().__init__(model, dtpolicy, env, data_per_iter)
+    """
+    sample_size: fit each tree on sample_size states drawn in proportion to their disagreement weights
+    (as in the VIPER paper) instead of the whole weighted dataset, the accuracy is then estimated on
+    holdout_size other states. patience: stop once neither the accuracy (by more than acc_tol) nor the
+    evaluation reward (by more than reward_tol) improved for patience iterations.
+    scorer, top_k: see DecisionTreeExtractor, the early stopping uses the rollout rewards either way.
+    """
+    def __init__(self, model: PPO, dtpolicy: DecisionTreeClassifier, env: Env, rtpt, data_per_iter: int=30_000, dataset_path=None,
+                 sample_size=None, holdout_size=5_000, patience=None, acc_tol=0.005, reward_tol=0.0, seed=0, scorer: TreeScorer=None, top_k=None):
+        super().__init__(model, dtpolicy, env, data_per_iter, dataset_path, scorer, top_k)
         self.Q = LogProbQ(self.model, self.env)
         self.rtpt = rtpt
+        self.sample_size = sample_size
+        self.holdout_size = holdout_size
+        self.patience = patience
+        self.acc_tol = acc_tol
+        self.reward_tol = reward_tol
+        self.rng = np.random.default_rng(seed)
 
     def fit_DT(self, S, A, weights):
         self.dt.fit(S, A, weights)
         acc = self.dt.score(S, A, weights)
         return acc
 
-    def imitate(self, nb_iter: int):
+    def fit_dataset(self, D):
+        if self.sample_size is None:
+            return self.fit_DT(D.states, D.actions, D.weights)
+        holdout = np.sort(self.rng.choice(D.n, min(self.holdout_size, D.n // 2), replace=False))
+        p = np.array(D.weights, dtype=np.float64)
+        if p.sum() - p[holdout].sum() <= 0: # oracle agrees everywhere
+            p[:] = 1
+        p[holdout] = 0
+        train = np.sort(self.rng.choice(D.n, self.sample_size, p=p / p.sum())) # sorted: sequential reads from memmaps
+        self.dt.fit(D.states[train], D.actions[train])
+        return self.dt.score(D.states[holdout], D.actions[holdout], D.weights[holdout])
+
+    def converged(self):
+        if self.patience is None:
+            return False
+        return plateaued(self.list_acc, self.patience, self.acc_tol) and plateaued(self.list_eval, self.patience, self.reward_tol)
+
+    def imitate(self, nb_iter: int, datasets=None):
         start_time = time.time()
-        self.list_acc, self.list_eval, self.list_dt, self.times =[], [], [], []
-        DS, DA = self.collect_data()
-        weights = [self.Q.get_disagreement_cost(s).item() for s in DS] # could be sped up
+        self.list_acc, self.list_eval, self.times =[], [], []
+        self.trees, self.scores, self.pending = {}, {}, {}
+        self.dataset = self._new_dataset(nb_iter, datasets)
+        D = self.dataset
+        self.add_initial(D, datasets, self.Q.get_disagreement_cost) # weights of the initial states are computed once, here
 
-        acc_dt = self.fit_DT(DS, DA, weights)
+        acc_dt = self.fit_dataset(D)
         S_dt, eval_dt = self.collect_data_dt()
         self.times.append(time.time()-start_time)
         print("Accuracy: {} - Evaluation: {}".format(acc_dt, eval_dt))
-        self.list_dt.append(deepcopy(self.dt))
         self.list_acc.append(acc_dt)
         self.list_eval.append(eval_dt)
-        DS = np.concatenate((DS, S_dt))
-        DA = np.concatenate((DA, self.model.predict(S_dt)[0]))
-        weights += [self.Q.get_disagreement_cost(s).item() for s in S_dt]
+        self.add_tree()
+        D.append(S_dt, self.model.predict(S_dt)[0], self.Q.get_disagreement_cost(S_dt)) # weights of the new states only
 
         for _ in range(nb_iter - 1):
             self.rtpt.step()
-            acc_dt = self.fit_DT(DS, DA, weights)
+            acc_dt = self.fit_dataset(D)
             S_dt, eval_dt = self.collect_data_dt()
             self.times.append(time.time()-start_time)
             print("Accuracy: {} - Evaluation: {}".format(acc_dt, eval_dt))
-            self.list_dt.append(deepcopy(self.dt))
             self.list_acc.append(acc_dt)
             self.list_eval.append(eval_dt)
-            DS = np.concatenate((DS, S_dt))
-            DA = np.concatenate((DA, self.model.predict(S_dt)[0]))
-            weights += [self.Q.get_disagreement_cost(s).item() for s in S_dt]
+            self.add_tree()
+            if self.converged():
+                print("Accuracy and evaluation plateaued, stopping after {} iterations".format(len(self.list_eval)))
+                break
+            D.append(S_dt, self.model.predict(S_dt)[0], self.Q.get_disagreement_cost(S_dt))
@@ -1,15 +1,18 @@
+import csv
 from pathlib import Path
 
 import argparse
 import numpy as np
-from joblib import load
+from joblib import dump
 from rtpt import RTPT
 from sklearn.tree import DecisionTreeClassifier
 from stable_baselines3 import PPO
 from stable_baselines3.common.vec_env import VecNormalize, DummyVecEnv
 
 from scobi import Environment
-from ns_policies.SCoBOts_framework.utils.viper import VIPER
+from ns_policies.SCoBOts_framework.utils.viper import VIPER, TreeScorer, load_recorded
+from utils.evaluation import make_eval_pool, load_vecnormalize
+from utils.tree_kernel import load_compiled_tree
 
 EVAL_ENV_SEED = 84
 
@@ -73,12 +76,41 @@ def eval_agent(model, env, episodes, obs_save_file=None, acts_save_file=None):
             break
 
 
+# Fits and scores the trees of the sweep, saves all results and the trees of the reward-versus-size Pareto front
+def _save_sweep(vip, scorer, param_grid, output_path):
+    vip.scorer = scorer
+    results, front = vip.sweep(param_grid)
+    sweep_path = output_path / "sweep"
+    sweep_path.mkdir(parents=True, exist_ok=True)
+    with open(sweep_path / "sweep.csv", mode="w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["max_depth", "max_leaf_nodes", "depth", "leaves", "reward", "pareto"])
+        for r in results:
+            writer.writerow([r["params"].get("max_depth"), r["params"].get("max_leaf_nodes"), r["depth"], r["leaves"],
+                             r["reward"], any(r is f for f in front)])
+    print("Pareto front (leaves: reward):")
+    for r in front:
+        print(f"{r['leaves']} leaves, depth {r['depth']}: {r['reward']:.2f}")
+        dump(r["tree"], sweep_path / f"Tree-depth{r['depth']}_leaves{r['leaves']}_{r['reward']}.viper")
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", type=str, required=True, help="checkpoint folder name containing 'best_model.zip' and 'best_vecnormalize.pkl'")
     parser.add_argument("-r", "--rule_extraction", type=str, required=True, choices=["viper"], default="viper", help="rule extraction to use.")
     parser.add_argument("-e", "--episodes", type=int, required=False, help="number of episodes to evaluate agents samples on")
     parser.add_argument("-n", "--name", type=str, required=False, help="experiment name")
+    parser.add_argument("-env", "--environments", type=int, default=8, help="number of environments the viper rollouts are spread over")
+    parser.add_argument("--shards", type=int, default=1, help="number of processes the rollout environments are split over (default: all in one process)")
+    parser.add_argument("--memmap", action="store_true", help="keep the aggregated viper dataset in memory-mapped files under the output folder instead of RAM")
+    parser.add_argument("--sample-size", type=int, required=False, help="fit each tree on this many states drawn by their viper weights instead of the whole dataset")
+    parser.add_argument("--patience", type=int, required=False, help="stop once accuracy and evaluation reward did not improve for this many iterations")
+    parser.add_argument("--score-workers", type=int, default=0, help="score the trees of the iterations on the same episodes in this many processes (default: by their rollout reward)")
+    parser.add_argument("--top-k", type=int, required=False, help="only keep the k best trees in memory and on disk")
+    parser.add_argument("--depth-sweep", type=int, nargs="+", required=False, help="fit and score trees of these max depths on the final dataset, e.g. 3 4 5 6 7 8 9 10")
+    parser.add_argument("--leaf-sweep", type=int, nargs="+", required=False, help="fit and score trees with these max leaf counts on the final dataset")
+    parser.add_argument("-d", "--datasets", type=str, nargs="+", required=False, help="additional folders with recorded 'obs.npy' and 'acts.npy' (e.g. of earlier extractions) to start viper from")
+    parser.add_argument("--fresh", action="store_true", help="start viper from fresh oracle rollouts instead of the recorded observations and actions (recordings of less than 30k states are always topped up with fresh rollouts to 30k)")
     opts = parser.parse_args()
 
     # Default values
@@ -150,7 +182,7 @@ def main():
 
 
     # Original SB3 Model Eval and Trainset Generation
-    model = PPO.load(model_path, device="cuda:0")
+    model = PPO.load(model_path) # cuda if available
     sb3_model_wrapped = SB3Model(model=model)
     dummy_vecenv = DummyVecEnv([lambda :  env])
     vec_env = VecNormalize.load(vecnorm_path, dummy_vecenv)
@@ -166,17 +198,29 @@ def main():
         process_name = checkpoint_name + "_" + expname
         rtpt = RTPT(name_initials="RE", experiment_name=process_name, max_iterations=NB_ITER)
         rtpt.start()
-        train_observations = np.load(obs_outfile)
-        train_actions = np.load(acts_outfile)
+        # initial dataset: the oracle observations and actions recorded above plus the given ones, at least 30k states
+        datasets = None if opts.fresh else [load_recorded(p) for p in [output_path] + (opts.datasets or [])]
         clf = DecisionTreeClassifier(max_depth=MAX_DEPTH)
-        vip = VIPER(model, clf, vec_env, rtpt)
-        vip.imitate(nb_iter=NB_ITER)
+        # rollouts over a pool of envs (env i seeded with EVAL_ENV_SEED + i), normalized with the checkpoint statistics
+        rollout_env = load_vecnormalize(vecnorm_path, make_eval_pool("scobots", env_str, focus_dir, pruned_ff_name, False, EVAL_ENV_SEED,
+                                                                     n_envs=opts.environments, n_shards=opts.shards))
+        param_grid = [{"max_depth": d} for d in opts.depth_sweep or []] + [{"max_leaf_nodes": l} for l in opts.leaf_sweep or []]
+        n_score_workers = max(opts.score_workers, 1 if param_grid else 0)
+        scorer = TreeScorer(env_str, focus_dir, pruned_ff_name, vecnorm_path, episodes, n_score_workers) if n_score_workers else None
+        vip = VIPER(model, clf, rollout_env, rtpt, dataset_path=output_path / "dataset" if opts.memmap else None,
+                    sample_size=opts.sample_size, patience=opts.patience, scorer=scorer if opts.score_workers else None, top_k=opts.top_k)
+        vip.imitate(nb_iter=NB_ITER, datasets=datasets)
         vip.save_best_tree(output_path)
+        rollout_env.close()
+        if param_grid:
+            _save_sweep(vip, scorer, param_grid, output_path)
+        if scorer is not None:
+            scorer.close()
         best_viper = sorted(output_path.glob("*_best.viper"))
         if not best_viper:
             print("error")
             exit()
-        dtree = load(best_viper[0]) #only one should exist
+        dtree = load_compiled_tree(best_viper[0]) #only one should exist
         viper_wrapped = DTClassifierModel(dtree)
         eval_agent(viper_wrapped, vec_env, episodes=episodes)
         print("Done!")